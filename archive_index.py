@@ -0,0 +1,188 @@
+"""Manifests of what is in each zip volume, and an index across all of them.
+
+Every volume gets a MANIFEST_FILE listing the Slack files in it, and each
+file is also added to an INDEX_FILE kept next to the volumes, which grows
+with every run. Along with each file's Slack details, both record where its
+entry starts in the volume, so it can be extracted with a single seek rather
+than by opening (or downloading) the volumes one by one.
+"""
+import csv
+import io
+import os
+import struct
+import threading
+import zipfile
+import zlib
+
+from slack_dedup import DUPLICATES_FILE
+
+MANIFEST_FILE = 'manifest.csv'
+INDEX_FILE = 'archive_index.csv'
+MANIFEST_ATTRIBUTES = ['id',       'name',          'user',
+                       'channels', 'created',       'size',
+                       'volume',   'arcname',       'offset',
+                       'compress_size', 'compress_type', 'crc']
+
+# Zip local file header: signature, version, flags, compression, time, date,
+# CRC-32, compressed size, uncompressed size, name length, extra field length
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Files that are zip metadata rather than Slack files
+METADATA_FILES = {MANIFEST_FILE, DUPLICATES_FILE}
+
+def manifest_row(info, volume, slackfile=None):
+    """The manifest entry for the zip member `info` in the zip file named
+    `volume`, with the details of the SlackFile it came from, if known."""
+    row = { attr : '' for attr in MANIFEST_ATTRIBUTES }
+    if slackfile:
+        row.update(id=slackfile.id, name=slackfile.name, user=slackfile.user,
+                   channels=slackfile.channels, created=slackfile.created,
+                   size=slackfile.size)
+    else:
+        row['size'] = info.file_size
+    row.update(volume=os.path.basename(volume), arcname=info.filename,
+               offset=info.header_offset, compress_size=info.compress_size,
+               compress_type=info.compress_type, crc=info.CRC)
+    return row
+
+def manifest_csv(rows):
+    handle = io.StringIO()
+    writer = csv.DictWriter(handle, fieldnames=MANIFEST_ATTRIBUTES)
+    writer.writeheader()
+    writer.writerows(rows)
+    return handle.getvalue()
+
+def volume_manifest(zip_path, files_by_arcname=None):
+    """Manifest entries for every Slack file in an existing volume, filling in
+    their details from `files_by_arcname` (a dict of SlackFiles) where possible."""
+    files_by_arcname = files_by_arcname or {}
+    with zipfile.ZipFile(zip_path) as zip_archive:
+        return [manifest_row(info, zip_path, files_by_arcname.get(info.filename))
+                for info in zip_archive.infolist() if info.filename not in METADATA_FILES]
+
+def volume_references(zip_path):
+    """The references to copies in other volumes listed in a volume's
+    DUPLICATES_FILE, as tuples of slack_dedup.DUPLICATES_ATTRIBUTES."""
+    with zipfile.ZipFile(zip_path) as zip_archive:
+        if DUPLICATES_FILE not in zip_archive.namelist():
+            return []
+        text = zip_archive.read(DUPLICATES_FILE).decode('utf-8')
+    return [tuple(row) for row in list(csv.reader(io.StringIO(text)))[1:]]
+
+def reference_rows(folder, references, files_by_arcname=None):
+    """Index entries for files that were stored as references (tuples of
+    slack_dedup.DUPLICATES_ATTRIBUTES) rather than copies: each has the
+    details of the file itself, from `files_by_arcname` where possible, but
+    the volume, name and offset of the copy in `folder` that holds its bytes,
+    so it can be found and extracted like any other file."""
+    files_by_arcname = files_by_arcname or {}
+    rows = []
+    volumes = {}
+    try:
+        for arcname, _, original_volume, original_arcname in references:
+            if not original_volume:
+                continue
+            if original_volume not in volumes:
+                volumes[original_volume] = zipfile.ZipFile(os.path.join(folder, original_volume))
+            info = volumes[original_volume].getinfo(original_arcname)
+            rows.append(manifest_row(info, original_volume, files_by_arcname.get(arcname)))
+    finally:
+        for zip_archive in volumes.values():
+            zip_archive.close()
+    return rows
+
+def add_manifest(zip_path, rows):
+    """Add a manifest listing `rows` to the end of a volume."""
+    with zipfile.ZipFile(zip_path, mode='a', allowZip64=True) as zip_archive:
+        zip_archive.writestr(MANIFEST_FILE, manifest_csv(rows),
+                             compress_type=zipfile.ZIP_DEFLATED)
+
+_index_lock = threading.Lock()
+
+def append_index(path, rows):
+    """Add manifest rows to the index file at `path`."""
+    with _index_lock:
+        is_new = not os.path.exists(path)
+        with open(path, 'a', newline='') as handle:
+            writer = csv.DictWriter(handle, fieldnames=MANIFEST_ATTRIBUTES)
+            if is_new:
+                writer.writeheader()
+            writer.writerows(rows)
+
+def find(path, file_id=None, name=None):
+    """The index rows for the Slack file `file_id`, and/or with the original
+    name or archived name `name`."""
+    with open(path, newline='') as handle:
+        return [row for row in csv.DictReader(handle)
+                if (file_id is None or row['id'] == file_id)
+                and (name is None or name in (row['name'], row['arcname']))]
+
+def extract(folder, row, dest):
+    """Copy the file described by the index `row` from its volume in `folder`
+    to the binary file object `dest`, by seeking straight to its entry.
+    Returns the number of bytes written."""
+    compress_type = int(row['compress_type'])
+    if compress_type == zipfile.ZIP_STORED:
+        decompressor = None
+    elif compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    else:
+        raise ValueError("Can't extract %s: unsupported compression type %s"
+                         % (row['arcname'], compress_type))
+
+    with open(os.path.join(folder, row['volume']), 'rb') as volume:
+        volume.seek(int(row['offset']))
+        header = LOCAL_HEADER.unpack(volume.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise ValueError("No zip entry at offset %s of %s" % (row['offset'], row['volume']))
+        name_length, extra_length = header[9], header[10]
+        if volume.read(name_length).decode('utf-8', 'replace') != row['arcname']:
+            raise ValueError("%s isn't at offset %s of %s" % (row['arcname'], row['offset'],
+                                                              row['volume']))
+        volume.read(extra_length)
+
+        remaining = int(row['compress_size'])
+        crc = 0
+        written = 0
+        while remaining:
+            chunk = volume.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError("%s is cut short" % row['volume'])
+            remaining -= len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            crc = zlib.crc32(chunk, crc)
+            written += len(chunk)
+            dest.write(chunk)
+        if decompressor:
+            chunk = decompressor.flush()
+            crc = zlib.crc32(chunk, crc)
+            written += len(chunk)
+            dest.write(chunk)
+
+    if row.get('crc') and crc != int(row['crc']):
+        raise ValueError("CRC check failed for %s" % row['arcname'])
+    return written
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser("Find and extract archived Slack files")
+    parser.add_argument('-f', '--folder', type=str, help="Folder with the zip files and %s" % INDEX_FILE, required=True)
+    parser.add_argument('-i', '--id', type=str, help="Slack file ID to look for")
+    parser.add_argument('-n', '--name', type=str, help="Original or archived file name to look for")
+    parser.add_argument('-x', '--extract', action='store_true', help="Extract the matching files into the current folder")
+    args = parser.parse_args()
+
+    rows = find(os.path.join(args.folder, INDEX_FILE), args.id, args.name)
+    for row in rows:
+        print("%s  %s  (%s bytes, uploaded by %s on %s) in %s at offset %s" % (
+            row['id'], row['arcname'], row['size'], row['user'], row['created'],
+            row['volume'], row['offset']))
+        if args.extract:
+            with open(os.path.basename(row['arcname']), 'wb') as dest:
+                extract(args.folder, row, dest)
+    if not rows:
+        print("No matching files", file=sys.stderr)
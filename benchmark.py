@@ -0,0 +1,168 @@
+"""Benchmarks the cleanup pipeline against a fake Slack workspace.
+
+For each workspace size, starts a fake_slack_server, then runs the same
+steps as slack_cleanup_cron.main (listing, archiving and deleting, zipping,
+posting) and reports, for each step, how long it took, files and bytes per
+second, API calls made and the peak memory use so far.
+"""
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import fake_slack_server
+import slack_cleanup_cron
+import slack_directory
+import slack_file_cleanup
+import slack_policy
+import slack_utils
+import zipfolder
+
+TOKEN = 'xoxp-benchmark'
+UNLIMITED_RATE = 10 ** 9    # requests per minute
+
+def peak_rss_mb():
+    """Peak resident memory of this process and its (finished) children, in MB."""
+    # ru_maxrss is in KB on Linux but bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale / 1000000
+
+class PhaseTimer:
+    """Records the time, API calls and downloaded bytes for each phase of a run."""
+
+    def __init__(self, server):
+        self.server = server
+        self.phases = []
+
+    def run(self, name, func):
+        """Run `func`, which returns (files, bytes) processed, as phase `name`."""
+        calls_before = sum(self.server.calls.values())
+        start = time.perf_counter()
+        n_files, n_bytes = func()
+        seconds = time.perf_counter() - start
+        self.phases.append({
+            'phase': name,
+            'seconds': round(seconds, 3),
+            'files': n_files,
+            'files_per_sec': round(n_files / seconds, 1) if seconds else None,
+            'mb': round(n_bytes / 1000000, 2),
+            'mb_per_sec': round(n_bytes / 1000000 / seconds, 2) if seconds else None,
+            'api_calls': sum(self.server.calls.values()) - calls_before,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        })
+
+def configure(server, work_dir, real_rate_limits):
+    """Point the scripts at the fake server, quietly, with a clean slate."""
+    slack_utils.SLACK_API_URL = server.api_url
+    slack_utils._clients.clear()
+    slack_directory._directories.clear()
+    slack_directory.DIRECTORY_CACHE_DIR = work_dir
+    slack_file_cleanup.DOWNLOAD_DIR = os.path.join(work_dir, 'archive')
+    slack_file_cleanup.DEBUG = False
+    slack_directory.DEBUG = False
+    zipfolder.DEBUG = False
+
+    if not real_rate_limits:
+        for method in slack_utils.METHOD_RATE_LIMITS:
+            slack_utils.METHOD_RATE_LIMITS[method] = UNLIMITED_RATE
+        slack_utils.DEFAULT_RATE_LIMIT = UNLIMITED_RATE
+
+def run_benchmark(n_files, workers=slack_file_cleanup.DEFAULT_WORKERS,
+                  page_workers=slack_file_cleanup.DEFAULT_PAGE_WORKERS,
+                  page_size=slack_file_cleanup.DEFAULT_PAGE_SIZE,
+                  latency=0.0, rate_limit_fraction=0.0, max_size=16 * 1024,
+                  real_rate_limits=False):
+    """Run the cron pipeline against a fake workspace of `n_files` files and
+    return a list of per-phase results."""
+    workspace = fake_slack_server.FakeWorkspace(n_files=n_files, min_size=512, max_size=max_size)
+    server = fake_slack_server.FakeSlackServer(workspace, latency=latency,
+                                               rate_limit_fraction=rate_limit_fraction,
+                                               retry_after=0)
+    original_dir = os.getcwd()
+
+    with server, tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            configure(server, work_dir, real_rate_limits)
+            timer = PhaseTimer(server)
+            policy = slack_policy.load_policy(slack_policy.DEFAULT_POLICY_FILE)
+            files = []
+
+            def listing():
+                files.extend(slack_file_cleanup.get_files_to_act_on(
+                    TOKEN, policy.n_days_ago, None, page_workers, page_size))
+                files[:] = slack_file_cleanup.assign_file_actions(files, policy)
+                return len(files), 0
+
+            def actions():
+                os.mkdir(slack_file_cleanup.DOWNLOAD_DIR)
+                bytes_before = server.bytes_served
+                results = list(slack_file_cleanup.act_on_files(files, TOKEN, workers))
+                return len(results), server.bytes_served - bytes_before
+
+            zip_list = []
+
+            def zipping():
+                archived = zipfolder.list_files(slack_file_cleanup.DOWNLOAD_DIR)
+                zip_list.extend(zipfolder.zip_folder(
+                    slack_file_cleanup.DOWNLOAD_DIR,
+                    zipfile_prefix=os.path.join(work_dir, "{:%Y-%m-%d}".format(datetime.now())),
+                    rough_size_limit_mb=slack_cleanup_cron.ZIP_SIZE_LIMIT_MB))
+                return len(archived), sum(size for _, size in archived)
+
+            def posting():
+                msg = slack_cleanup_cron.make_markdown_message(zip_list, 'https://example.com/',
+                                                          policy.n_days_ago)
+                slack_utils.markdown_post_request(TOKEN, 'general', 'Benchmark', msg)
+                slack_utils.chat_post_request(TOKEN, 'general', 'Benchmark done')
+                return len(zip_list), 0
+
+            timer.run('list', listing)
+            timer.run('act', actions)
+            timer.run('zip', zipping)
+            timer.run('post', posting)
+        finally:
+            os.chdir(original_dir)
+
+    return timer.phases
+
+def print_results(n_files, phases):
+    print("\n%s files" % n_files)
+    print("%-6s %9s %8s %10s %9s %8s %9s %9s" % ('phase', 'seconds', 'files', 'files/s',
+                                                 'MB', 'MB/s', 'API calls', 'peak MB'))
+    for p in phases:
+        print("%-6s %9.2f %8d %10s %9.2f %8s %9d %9.1f" % (p['phase'], p['seconds'], p['files'],
+                                                         p['files_per_sec'], p['mb'],
+                                                         p['mb_per_sec'], p['api_calls'],
+                                                         p['peak_rss_mb']))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser("Benchmark the Slack cleanup pipeline against a fake workspace")
+    parser.add_argument('-f', '--files', type=int, nargs='+', help="Workspace sizes to try (default = 1000 10000)", default=[1000, 10000])
+    parser.add_argument('-w', '--workers', type=int, help="Number of downloads/deletes to run at once", default=slack_file_cleanup.DEFAULT_WORKERS)
+    parser.add_argument('-p', '--page_workers', type=int, help="Number of file list pages to fetch at once", default=slack_file_cleanup.DEFAULT_PAGE_WORKERS)
+    parser.add_argument('--page_size', type=int, help="Number of files per file list page", default=slack_file_cleanup.DEFAULT_PAGE_SIZE)
+    parser.add_argument('-l', '--latency', type=float, help="Seconds the fake server waits before each response (default = 0)", default=0.0)
+    parser.add_argument('-r', '--rate_limit_fraction', type=float, help="Fraction of API calls the fake server refuses with HTTP 429 (default = 0)", default=0.0)
+    parser.add_argument('-s', '--max_size', type=int, help="Largest fake file, in bytes (default = 16384)", default=16 * 1024)
+    parser.add_argument('--real_rate_limits', action='store_true', help="Throttle API calls to Slack's real rate limits")
+    parser.add_argument('-j', '--json', type=str, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    for n_files in args.files:
+        phases = run_benchmark(n_files, args.workers, args.page_workers, args.page_size,
+                               args.latency, args.rate_limit_fraction, args.max_size,
+                               args.real_rate_limits)
+        print_results(n_files, phases)
+        results[n_files] = phases
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,289 @@
+"""A local stand-in for the parts of the Slack Web API these scripts use,
+for benchmarking and trying things out without a real workspace.
+
+It serves a synthetic workspace of channels, users and files: files.list
+(with paging), channels.list and users.list (with cursors), channels.info,
+users.info, files.delete, files.upload, chat.postMessage, and the files
+themselves (with Range support). Every response can be delayed by a fixed
+latency, and a fraction of API calls can be answered with HTTP 429.
+
+Point the scripts at it by setting `slack_utils.SLACK_API_URL` to the
+server's `api_url`.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DAY = 24 * 60 * 60
+
+FILETYPES = ['jpg', 'jpg', 'jpg', 'png', 'png', 'mp4', 'mov', 'pdf', 'txt']
+CHANNEL_NAMES = ['general', 'random', 'food', 'techsupport', 'jokes_puns_comics']
+
+class FakeWorkspace:
+    """A synthetic workspace of `n_files` files (between `min_size` and
+    `max_size` bytes, uploaded over the last `days` days) shared by `n_users`
+    users in `n_channels` channels. The same `seed` gives the same workspace."""
+
+    def __init__(self, n_files=1000, n_channels=20, n_users=50,
+                 min_size=1024, max_size=64 * 1024, days=730, seed=0):
+        rng = random.Random(seed)
+        now = time.time()
+
+        self.channels = { 'C%06d' % i : CHANNEL_NAMES[i] if i < len(CHANNEL_NAMES)
+                                        else 'channel-%s' % i
+                          for i in range(n_channels) }
+        self.users = { 'U%06d' % i : 'user%s' % i for i in range(n_users) }
+        channel_ids = sorted(self.channels)
+        user_ids = sorted(self.users)
+
+        self.files = {}
+        for i in range(n_files):
+            file_id = 'F%08d' % i
+            # Every fifth file is a re-upload of the one before it
+            if i % 5 != 4:
+                filetype, size = rng.choice(FILETYPES), rng.randint(min_size, max_size)
+            # About one file in ten was only shared in a DM
+            shared = [] if rng.random() < 0.1 else rng.sample(channel_ids, rng.randint(1, 2))
+            self.files[file_id] = {
+                'id': file_id,
+                'name': 'file%s.%s' % (i, filetype),
+                'created': int(now - rng.uniform(0, days * DAY)),
+                'user': rng.choice(user_ids),
+                'size': size,
+                'channels': shared,
+                'filetype': filetype,
+            }
+        # files.list returns the newest files first
+        self.newest_first = sorted(self.files, key=lambda f: -self.files[f]['created'])
+        self.version = 0
+        self.cached_listing = None
+        self.lock = threading.Lock()
+
+    def content(self, file_id):
+        """The (deterministic) bytes of a file, or None if there is no such file.
+        Every fifth file has the same bytes as the one before it, so there is
+        something to deduplicate."""
+        f = self.files.get(file_id)
+        if f is None:
+            return None
+        number = int(file_id[1:])
+        return random.Random(number - 1 if number % 5 == 4 else number).randbytes(f['size'])
+
+    def delete(self, file_id):
+        with self.lock:
+            if self.files.pop(file_id, None) is None:
+                return False
+            self.version += 1
+            return True
+
+    def listing(self, ts_from, ts_to):
+        """The files created between `ts_from` and `ts_to`, newest first. Like
+        the real files.list, paging is by offset into this list, so deleting
+        files moves the later ones onto earlier pages."""
+        with self.lock:
+            key = (ts_from, ts_to, self.version)
+            if self.cached_listing is None or self.cached_listing[0] != key:
+                files = [self.files[f] for f in self.newest_first if f in self.files
+                         and ts_from <= self.files[f]['created'] <= ts_to]
+                self.cached_listing = (key, files)
+            return self.cached_listing[1]
+
+class FakeSlackServer:
+    """Runs a FakeWorkspace on a local HTTP server in a background thread.
+
+    `latency` seconds are added to every response; `rate_limit_fraction` of
+    API calls get an HTTP 429 with a Retry-After of `retry_after` seconds.
+    `calls` counts the API calls made to each method (including refused ones),
+    and `bytes_served` the file bytes downloaded.
+    """
+
+    def __init__(self, workspace, latency=0.0, rate_limit_fraction=0.0, retry_after=1,
+                 host='127.0.0.1', port=0):
+        self.workspace = workspace
+        self.latency = latency
+        self.rate_limit_fraction = rate_limit_fraction
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.bytes_served = 0
+        self.lock = threading.Lock()
+        self.rng = random.Random(1)
+
+        server = self
+
+        class Handler(SlackRequestHandler):
+            fake = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://%s:%s/' % self.httpd.server_address[:2]
+        self.api_url = self.url + 'api/'
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] += 1
+            return self.rng.random() < self.rate_limit_fraction
+
+    def file_url(self, file_id):
+        return self.url + 'files/' + file_id
+
+    # API methods: each takes the request's parameters and returns the response dict
+
+    def files_list(self, params):
+        ts_from = float(params.get('ts_from', 0))
+        ts_to = float(params.get('ts_to', time.time()))
+        count = int(params.get('count', 100))
+        page = int(params.get('page', 1))
+
+        matching = self.workspace.listing(ts_from, ts_to)
+        pages = max(1, -(-len(matching) // count))
+        files = [dict(f, url_private=self.file_url(f['id']))
+                 for f in matching[(page - 1) * count : page * count]]
+        return {'ok': True, 'files': files,
+                'paging': {'count': count, 'total': len(matching), 'page': page, 'pages': pages}}
+
+    def cursor_list(self, params, items, key, make_item):
+        ids = sorted(items)
+        start = int(params.get('cursor') or 0)
+        limit = int(params.get('limit', 0)) or len(ids)
+        end = start + limit
+        return {'ok': True, key: [make_item(i) for i in ids[start:end]],
+                'response_metadata': {'next_cursor': str(end) if end < len(ids) else ''}}
+
+    def channels_list(self, params):
+        channels = self.workspace.channels
+        return self.cursor_list(params, channels, 'channels',
+                                lambda i: {'id': i, 'name': channels[i]})
+
+    def users_list(self, params):
+        users = self.workspace.users
+        return self.cursor_list(params, users, 'members',
+                                lambda i: {'id': i, 'name': users[i]})
+
+    def channels_info(self, params):
+        name = self.workspace.channels.get(params.get('channel'))
+        if name is None:
+            return {'ok': False, 'error': 'channel_not_found'}
+        return {'ok': True, 'channel': {'id': params['channel'], 'name': name}}
+
+    def users_info(self, params):
+        name = self.workspace.users.get(params.get('user'))
+        if name is None:
+            return {'ok': False, 'error': 'user_not_found'}
+        return {'ok': True, 'user': {'id': params['user'], 'name': name}}
+
+    def files_delete(self, params):
+        if self.workspace.delete(params.get('file')):
+            return {'ok': True}
+        return {'ok': False, 'error': 'file_not_found'}
+
+    def files_upload(self, params):
+        return {'ok': True, 'file': {'id': 'FUPLOAD', 'title': params.get('title')}}
+
+    def chat_postMessage(self, params):
+        return {'ok': True, 'channel': params.get('channel'), 'ts': str(time.time())}
+
+    METHODS = {
+        'files.list': files_list,
+        'channels.list': channels_list,
+        'users.list': users_list,
+        'channels.info': channels_info,
+        'users.info': users_info,
+        'files.delete': files_delete,
+        'files.upload': files_upload,
+        'chat.postMessage': chat_postMessage,
+    }
+
+class SlackRequestHandler(BaseHTTPRequestHandler):
+    fake = None     # set to the FakeSlackServer by FakeSlackServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        time.sleep(self.fake.latency)
+        length = int(self.headers.get('Content-Length', 0))
+        params = { k : v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items() }
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+
+        if method not in FakeSlackServer.METHODS:
+            self.send_json(404, {'ok': False, 'error': 'unknown_method'})
+            return
+        if self.fake.count(method):
+            self.send_json(429, {'ok': False, 'error': 'ratelimited'},
+                           {'Retry-After': str(self.fake.retry_after)})
+            return
+        if params.get('token') is None:
+            self.send_json(200, {'ok': False, 'error': 'not_authed'})
+            return
+        self.send_json(200, FakeSlackServer.METHODS[method](self.fake, params))
+
+    def do_GET(self):
+        time.sleep(self.fake.latency)
+        file_id = urlparse(self.path).path.rsplit('/', 1)[-1]
+        data = self.fake.workspace.content(file_id)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        status, start = 200, 0
+        byte_range = self.headers.get('Range')
+        if byte_range and byte_range.startswith('bytes='):
+            start = int(byte_range[len('bytes='):].split('-')[0])
+            status = 206
+        body = data[start:]
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, len(data) - 1, len(data)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.fake.lock:
+            self.fake.bytes_served += len(body)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser("Fake Slack API server")
+    parser.add_argument('-f', '--files', type=int, help="Number of files in the workspace (default = 1000)", default=1000)
+    parser.add_argument('-p', '--port', type=int, help="Port to listen on (default = 8000)", default=8000)
+    parser.add_argument('-l', '--latency', type=float, help="Seconds to delay each response (default = 0)", default=0.0)
+    parser.add_argument('-r', '--rate_limit_fraction', type=float, help="Fraction of API calls to answer with HTTP 429 (default = 0)", default=0.0)
+    args = parser.parse_args()
+
+    server = FakeSlackServer(FakeWorkspace(n_files=args.files), latency=args.latency,
+                             rate_limit_fraction=args.rate_limit_fraction, port=args.port)
+    print("Serving a fake Slack API at %s" % server.api_url)
+    server.httpd.serve_forever()
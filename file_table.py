@@ -0,0 +1,172 @@
+import datetime
+from array import array
+from collections import Counter, defaultdict
+
+class Interner:
+    """Gives each distinct value a small integer code, so a column of values
+    can be stored as an array of codes."""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+class FileTable:
+    """A column-oriented inventory of Slack files.
+
+    Rather than one namedtuple per file, each field is kept in its own column:
+    sizes and creation times (as Unix timestamps) in int64 arrays, and users,
+    channel lists, file types, actions and results as integer codes into
+    Interners, so that each distinct name is only stored once. Totals,
+    grouping and action assignment work down whole columns.
+
+    `row_type` is the namedtuple used for individual files (SlackFile), with
+    the fields id, name, permalink, created, user, size, channels, filetype,
+    action and result.
+    """
+
+    def __init__(self, row_type, files=()):
+        self.row_type = row_type
+        self.ids = []
+        self.names = []
+        self.permalinks = []
+        self.created = array('q')
+        self.sizes = array('q')
+        self.users = array('I')
+        self.channels = array('I')
+        self.filetypes = array('I')
+        self.actions = array('B')
+        self.results = array('B')
+        self.user_names = Interner()
+        self.channel_names = Interner()
+        self.filetype_names = Interner()
+        self.action_names = Interner()
+        self.result_names = Interner()
+        self.extend(files)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, file):
+        self.ids.append(file.id)
+        self.names.append(file.name)
+        self.permalinks.append(file.permalink)
+        self.created.append(int(file.created.timestamp()))
+        self.sizes.append(file.size)
+        self.users.append(self.user_names.code(file.user))
+        self.channels.append(self.channel_names.code(file.channels))
+        self.filetypes.append(self.filetype_names.code(file.filetype))
+        self.actions.append(self.action_names.code(file.action))
+        self.results.append(self.result_names.code(file.result))
+
+    def extend(self, files):
+        for file in files:
+            self.append(file)
+
+    def extend_rows(self, rows):
+        """Add rows straight from the inventory, without making a `row_type`
+        for each of them first: tuples of the `row_type` fields in order, with
+        `created` as a timestamp."""
+        user_code = self.user_names.code
+        channel_code = self.channel_names.code
+        filetype_code = self.filetype_names.code
+        action_code = self.action_names.code
+        result_code = self.result_names.code
+        for (file_id, name, permalink, created, user, size,
+             channels, filetype, action, result) in rows:
+            self.ids.append(file_id)
+            self.names.append(name)
+            self.permalinks.append(permalink)
+            self.created.append(int(created))
+            self.sizes.append(size)
+            self.users.append(user_code(user))
+            self.channels.append(channel_code(channels))
+            self.filetypes.append(filetype_code(filetype))
+            self.actions.append(action_code(action))
+            self.results.append(result_code(result))
+
+    def file(self, index):
+        """Returns the file at `index` as a `row_type`."""
+        return self.row_type(id=self.ids[index],
+                             name=self.names[index],
+                             permalink=self.permalinks[index],
+                             created=datetime.datetime.fromtimestamp(self.created[index]),
+                             user=self.user_names[self.users[index]],
+                             size=self.sizes[index],
+                             channels=self.channel_names[self.channels[index]],
+                             filetype=self.filetype_names[self.filetypes[index]],
+                             action=self.action_names[self.actions[index]],
+                             result=self.result_names[self.results[index]])
+
+    def iter_files(self):
+        for index in range(len(self)):
+            yield self.file(index)
+
+    def set_action(self, index, action):
+        self.actions[index] = self.action_names.code(action)
+
+    def assign_actions(self, policy):
+        """Set every file's action from `policy` (a slack_policy.Policy). The
+        rules that might apply are only worked out once for each distinct file
+        type, channel list and user; after that, only their age and size ranges
+        are checked for each file."""
+        decided = {}
+        actions, created, sizes = self.actions, self.created, self.sizes
+        for index, key in enumerate(zip(self.filetypes, self.channels, self.users)):
+            candidates = decided.get(key)
+            if candidates is None:
+                filetype, channels, user = key
+                candidates = decided[key] = [
+                    ranges[:-1] + (self.action_names.code(ranges[-1]),)
+                    for ranges in policy.candidates(self.filetype_names[filetype],
+                                                    self.channel_names[channels],
+                                                    self.user_names[user])]
+            actions[index] = policy.pick(candidates, created[index], sizes[index])
+
+    def action_codes(self, action):
+        """The codes of every action name containing `action` (so 'delete'
+        matches 'archive,delete' too)."""
+        return { code for code, name in enumerate(self.action_names.values) if action in name }
+
+    def select(self, action=None, min_size=None, created_before=None):
+        """Returns the indexes of the files matching all of the conditions given."""
+        codes = self.action_codes(action) if action is not None else None
+        return [index for index, (code, size, created)
+                in enumerate(zip(self.actions, self.sizes, self.created))
+                if (codes is None or code in codes)
+                and (min_size is None or size > min_size)
+                and (created_before is None or created <= created_before)]
+
+    def totals(self, column):
+        """Number of files and total bytes for each value of `column` (one of
+        'user', 'channels', 'filetype', 'action' or 'result')."""
+        codes, names = {
+            'user': (self.users, self.user_names),
+            'channels': (self.channels, self.channel_names),
+            'filetype': (self.filetypes, self.filetype_names),
+            'action': (self.actions, self.action_names),
+            'result': (self.results, self.result_names),
+        }[column]
+        counts = Counter(codes)
+        sizes = defaultdict(int)
+        for code, size in zip(codes, self.sizes):
+            sizes[code] += size
+        return { names[code] : (count, sizes[code]) for code, count in counts.items() }
+
+    def write_csv(self, log_name, fieldnames):
+        """Write the whole table to a CSV file in one pass."""
+        import csv
+        with open(log_name, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            for file in self.iter_files():
+                writer.writerow(file._asdict())
@@ -3,14 +3,18 @@ import os
 
 # Modules from this project
 from slack_utils import markdown_post_request, chat_post_request
+from slack_metrics import metrics
+import slack_dedup
 import slack_file_cleanup
-import zipfolder
+import slack_policy
 
-AGE_LIMIT_DAYS = 90
-NON_ARCHIVE_CHANNELS = "food,techsupport,jokes_puns_comics"
+ZIP_SIZE_LIMIT_MB = 500
+CONTENT_INDEX_FILE = 'content_index.sqlite'
+METRICS_JSON_FILE = 'slack_cleanup_metrics.json'
+METRICS_PROMETHEUS_FILE = 'slack_cleanup.prom'
 
-def make_markdown_message(file_list, url_prefix):
-    cutoff_date = datetime.now() - timedelta(days=AGE_LIMIT_DAYS)
+def make_markdown_message(file_list, url_prefix, n_days_ago, index_file=None):
+    cutoff_date = datetime.now() - timedelta(days=n_days_ago)
     
     message_markdown = """To save space, files older than {:%B %d, %Y} have been deleted from this Slack account. 
     These old files have been saved in zip file{plural} which you can download using the link{plural}
@@ -23,37 +27,128 @@ def make_markdown_message(file_list, url_prefix):
         file_url = os.path.join(url_prefix, file_name)
         message_markdown += "* [`{url}`]({url}) ({size} MB)\n".format(url=file_url,size=size_mb)
     
+    if index_file:
+        index_url = os.path.join(url_prefix, os.path.basename(index_file))
+        message_markdown += ("\nTo find a particular file in these or earlier archives, "
+                             "look it up in the [index]({url}).\n").format(url=index_url)
+    
     return message_markdown.format(cutoff_date, plural=plural_suffix)
 
-def main(token, folder, url_folder, notify_channel, do_actions=False):
+def add_manifests(zip_list, index_path, log_name=None, dedup_index=None):
+    """Add a manifest to each of the zip files in `zip_list` and their files
+    (including those stored as references to another copy) to the index, with
+    the files' Slack details from the CSV log, if there is one.
+    The copies recorded in the `dedup_index` database, if given, are updated
+    with the volumes they ended up in."""
+    import archive_index
+    files = {}
+    if log_name and os.path.exists(log_name):
+        files = { slack_file_cleanup.filename_string(f) : f
+                  for f in slack_file_cleanup.read_log(log_name) }
+    volumes = {}
+    for zip_path in zip_list:
+        rows = archive_index.volume_manifest(zip_path, files)
+        archive_index.add_manifest(zip_path, rows)
+        archive_index.append_index(index_path, rows)
+        volumes.update((row['arcname'], row['volume']) for row in rows)
+    
+    if dedup_index:
+        dedup = slack_dedup.ContentIndex(dedup_index)
+        dedup.set_volumes(volumes)
+        dedup.close()
+    
+    # Files stored as references to a copy in an earlier volume are indexed
+    # too, pointing at that copy
+    folder = os.path.dirname(index_path)
+    for zip_path in zip_list:
+        rows = archive_index.reference_rows(folder, archive_index.volume_references(zip_path),
+                                            files)
+        if rows:
+            archive_index.append_index(index_path, rows)
+
+def main(token, folder, url_folder, notify_channel, do_actions=False, stream_zip=False,
+         dedup=False, metrics_dir=None, policy=slack_policy.DEFAULT_POLICY_FILE,
+         reset_metrics=True, **cleanup_options):
+    """Run the cleanup, zip the archived files into `folder` and announce them
+    in `notify_channel`. Any `cleanup_options` are passed on to
+    slack_file_cleanup.main. Returns the cleanup's tally and the zip files."""
     
-    slack_file_cleanup.main(token, do_actions,
-                            n_days_ago=AGE_LIMIT_DAYS,
-                            channels_noarchive=NON_ARCHIVE_CHANNELS)
+    if reset_metrics:
+        metrics.reset()
+    policy = slack_policy.load_policy(policy)
+    n_days_ago = policy.n_days_ago
+    if n_days_ago is None:
+        n_days_ago = slack_file_cleanup.DEFAULT_DAYS_AGO
     
     today = datetime.now()
     last_month = date(today.year, today.month, 1) - timedelta(days=1)
     date_string = "{:%Y-%m-%d}".format(today)
     post_title = "{td} Archives".format(td=date_string)
     
+    zip_writer = None
     if do_actions:
-        zip_list = zipfolder.zip_folder(slack_file_cleanup.DOWNLOAD_DIR,
-                                        zipfile_prefix=date_string,
-                                        rough_size_limit_mb=500)
+        # Zipping is only needed for real runs, so it's loaded here rather than
+        # slowing down every start
+        import archive_index
+        import zipfolder
         
-        for index, zfile in enumerate(zip_list):
-            new_name = os.path.join(folder, os.path.basename(zfile))
-            os.rename(zfile, new_name)
-            zip_list[index] = new_name
+        # Every archived file is listed in an index of all the runs' zip files
+        index_path = os.path.join(folder, archive_index.INDEX_FILE)
+        
+        # With stream_zip, files go straight from Slack into zip files in `folder`
+        if stream_zip:
+            zip_writer = zipfolder.ZipStreamWriter(date_string,
+                                                   rough_size_limit_mb=ZIP_SIZE_LIMIT_MB,
+                                                   folder=folder,
+                                                   index_path=index_path)
+    
+    dedup_index = os.path.join(folder, CONTENT_INDEX_FILE) if dedup else None
+    with metrics.timer('phase', step='cleanup'):
+        tally = slack_file_cleanup.main(token, do_actions,
+                                        n_days_ago=n_days_ago,
+                                        policy=policy,
+                                        zip_writer=zip_writer,
+                                        dedup_index=dedup_index,
+                                        **cleanup_options)
+    
+    if do_actions:
+        if zip_writer:
+            zip_list = zip_writer.close()
+        else:
+            with metrics.timer('phase', step='zip'):
+                zip_list = zipfolder.zip_folder(slack_file_cleanup.DOWNLOAD_DIR,
+                                                zipfile_prefix=date_string,
+                                                rough_size_limit_mb=ZIP_SIZE_LIMIT_MB)
+            
+            for index, zfile in enumerate(zip_list):
+                new_name = os.path.join(folder, os.path.basename(zfile))
+                os.rename(zfile, new_name)
+                zip_list[index] = new_name
+            
+            # TODO : delete files in slack_file_cleanup.DOWNLOAD_DIR
             
-        # TODO : delete files in slack_file_cleanup.DOWNLOAD_DIR
-        msg = make_markdown_message(zip_list, url_prefix=url_folder)
-        markdown_post_request(token, channels=notify_channel, title=post_title, content=msg)
-        chat_post_request(token, channel=notify_channel, message='@channel: Latest archives are ready!')
+            add_manifests(zip_list, index_path,
+                          None if cleanup_options.get('logging_off')
+                          else cleanup_options.get('log_name', slack_file_cleanup.LOG_FILE),
+                          dedup_index)
+
+        msg = make_markdown_message(zip_list, url_prefix=url_folder,
+                                    n_days_ago=n_days_ago,
+                                    index_file=index_path if os.path.exists(index_path) else None)
+        with metrics.timer('phase', step='post'):
+            markdown_post_request(token, channels=notify_channel, title=post_title, content=msg)
+            chat_post_request(token, channel=notify_channel, message='@channel: Latest archives are ready!')
     else:
-        msg = make_markdown_message([], url_prefix=url_folder)
+        zip_list = []
+        msg = make_markdown_message([], url_prefix=url_folder, n_days_ago=n_days_ago)
         print("Slack message for {chan}:".format(chan=notify_channel))
         print(msg)
+    
+    if metrics_dir:
+        metrics.write_json(os.path.join(metrics_dir, METRICS_JSON_FILE))
+        metrics.write_prometheus(os.path.join(metrics_dir, METRICS_PROMETHEUS_FILE))
+    
+    return tally, zip_list
 
 if __name__ == '__main__':
     import argparse
@@ -63,4 +158,8 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--folder', type=str, help="Folder to store zip files")
     parser.add_argument('-u', '--url_folder', type=str, help="Public directory URL where files can be downloaded")
     parser.add_argument('-n', '--notify_channel', type=str, help="Channel to post notification and download links")
+    parser.add_argument('-z', '--stream_zip', action='store_true', help="Download files straight into the zip files instead of a folder first")
+    parser.add_argument('-x', '--dedup', action='store_true', help="Only archive one copy of identical files, across all runs")
+    parser.add_argument('-m', '--metrics_dir', type=str, help="Folder to write a JSON summary and a Prometheus textfile of the run's timings and counts")
+    parser.add_argument('-p', '--policy', type=str, help="JSON file of rules deciding what to do with each file (default = default_policy.json)", default=slack_policy.DEFAULT_POLICY_FILE)
     main(**vars(parser.parse_args()))
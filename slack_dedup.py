@@ -0,0 +1,114 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+
+DUPLICATES_FILE = 'duplicates.csv'
+DUPLICATES_ATTRIBUTES = ['arcname', 'sha256', 'original_volume', 'original_arcname']
+
+def new_hash():
+    return hashlib.sha256()
+
+class ContentIndex:
+    """A persistent, content-addressed index of archived files.
+
+    Maps the SHA-256 of each archived file's contents to where the first copy
+    was stored (the name it was archived under and, once known, the zip volume
+    it went into), and each Slack file id to the hash of its contents. A file
+    whose contents are already in the index only needs a reference to the
+    first copy, not another copy of the bytes; a file whose id is already in
+    the index doesn't need downloading at all. Copies only count once they are
+    in a zip volume, so a reference can never point at a copy that failed or
+    was left in a download folder that never got zipped.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS content (
+                sha256  TEXT PRIMARY KEY,
+                size    INTEGER,
+                arcname TEXT,
+                volume  TEXT
+            );
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                file_id TEXT PRIMARY KEY,
+                sha256  TEXT
+            );
+        """)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def hash_for_file(self, file_id):
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM file_hashes WHERE file_id = ?",
+                                  (file_id,)).fetchone()
+        return row[0] if row else None
+
+    def location(self, sha256):
+        """Returns (arcname, volume) of the copy of `sha256` stored in a zip
+        volume, or None."""
+        with self.lock:
+            return self.db.execute("""SELECT arcname, volume FROM content
+                                      WHERE sha256 = ? AND volume IS NOT NULL""",
+                                   (sha256,)).fetchone()
+
+    def add_copy(self, sha256, size, arcname, volume=None):
+        """Record that the contents `sha256` are stored as `arcname` (in the
+        zip `volume`, if known; see `set_volumes`), unless a copy in a zip
+        volume was already recorded."""
+        with self.lock:
+            self.db.execute("""INSERT INTO content (sha256, size, arcname, volume)
+                               VALUES (?, ?, ?, ?)
+                               ON CONFLICT (sha256) DO UPDATE
+                               SET size = excluded.size, arcname = excluded.arcname,
+                                   volume = excluded.volume
+                               WHERE content.volume IS NULL""",
+                            (sha256, size, arcname, volume))
+            self.db.commit()
+
+    def set_volumes(self, volumes):
+        """Fill in the zip volume of copies recorded without one, from a dict
+        mapping the names they were archived under to their volumes."""
+        with self.lock:
+            self.db.executemany("UPDATE content SET volume = ? WHERE arcname = ? AND volume IS NULL",
+                                [(volume, arcname) for arcname, volume in volumes.items()])
+            self.db.commit()
+
+    def add_file(self, file_id, sha256):
+        """Record that the Slack file `file_id` has the contents `sha256`."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO file_hashes (file_id, sha256) VALUES (?, ?)",
+                            (file_id, sha256))
+            self.db.commit()
+
+def duplicates_csv(references):
+    """Returns the text of a duplicates manifest listing `references`, each a
+    tuple of DUPLICATES_ATTRIBUTES."""
+    import csv
+    handle = io.StringIO()
+    writer = csv.writer(handle)
+    writer.writerow(DUPLICATES_ATTRIBUTES)
+    writer.writerows(references)
+    return handle.getvalue()
+
+_duplicates_lock = threading.Lock()
+
+def append_duplicate(path, reference):
+    """Add a reference to the duplicates manifest file at `path`."""
+    import csv
+    with _duplicates_lock:
+        is_new = not os.path.exists(path)
+        with open(path, 'a', newline='') as handle:
+            writer = csv.writer(handle)
+            if is_new:
+                writer.writerow(DUPLICATES_ATTRIBUTES)
+            writer.writerow(reference)
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from slack_utils import get_client
+from slack_metrics import metrics
+
+DEBUG = True
+DIRECTORY_TTL = 24 * 60 * 60    # seconds before the cached names are refreshed
+DIRECTORY_PAGE_SIZE = 200
+DIRECTORY_CACHE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def list_pages(token, type, page_size=DIRECTORY_PAGE_SIZE):
+    """Yield each page of a channels.list or users.list response, following
+    `response_metadata.next_cursor` until there are no more. Raises IOError if
+    a page can't be fetched."""
+    # See https://api.slack.com/docs/pagination
+    cursor = None
+    while True:
+        data = {'limit': page_size}
+        if cursor:
+            data['cursor'] = cursor
+        resp = get_client(token).api_call('%s.list' % type, data)
+        if not resp:
+            raise IOError("Couldn't list %s" % type)
+        yield resp
+
+        cursor = resp.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return
+
+class Directory:
+    """Maps channel and user IDs to their names.
+
+    The full lists are fetched from Slack at most once every `ttl` seconds and
+    kept in a JSON file at `cache_path` in between. IDs that aren't in the
+    lists (e.g. users who were deleted after the cache was made) are looked up
+    one by one with `resolve_files`; if Slack doesn't know them either, the ID
+    itself is used as the name.
+    """
+
+    def __init__(self, token, cache_path=None, ttl=DIRECTORY_TTL):
+        self.token = token
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.channels = {}
+        self.users = {}
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Load the names from the cache, or from Slack if the cache is
+        missing or stale. Returns False if neither worked."""
+        with metrics.timer('directory'):
+            return self._load()
+
+    def _load(self):
+        if self.cache_path and os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            if time.time() - cache['fetched'] < self.ttl:
+                self.channels = cache['channels']
+                self.users = cache['users']
+                self.fetched = cache['fetched']
+                return True
+
+        try:
+            self.refresh()
+        except IOError as e:
+            print(e, file=sys.stderr)
+            return False
+        return True
+
+    def refresh(self):
+        """Fetch the complete channel and user lists from Slack."""
+        channels = {}
+        for page in list_pages(self.token, 'channels'):
+            channels.update({ c['id'] : c['name'] for c in page['channels'] })
+
+        users = {}
+        for page in list_pages(self.token, 'users'):
+            users.update({ user['id'] : user['name'] for user in page['members'] })
+
+        self.channels, self.users = channels, users
+        self.fetched = time.time()
+        self.save()
+
+    def save(self):
+        if not self.cache_path:
+            return
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'fetched': self.fetched,
+                       'channels': self.channels,
+                       'users': self.users}, f)
+        os.replace(temp_path, self.cache_path)
+
+    def lookup(self, type, id):
+        # See https://api.slack.com/methods/channels.info
+        # and https://api.slack.com/methods/users.info
+        key = 'channel' if type == 'channels' else 'user'
+        resp = get_client(self.token).api_call('%s.info' % type, {key: id})
+        return resp[key]['name'] if resp else id
+
+    def resolve_files(self, files):
+        """Make sure every channel and user referred to by `files` (raw
+        files.list results) has a name, looking up the unknown ones together."""
+        with self.lock:
+            unknown_channels = { c for f in files for c in f['channels'] } - self.channels.keys()
+            unknown_users = { f['user'] for f in files } - self.users.keys()
+            if not (unknown_channels or unknown_users):
+                return
+
+            metrics.count('directory_lookups', len(unknown_channels) + len(unknown_users))
+            if DEBUG:
+                print("Looking up %s channels and %s users" % (len(unknown_channels),
+                                                               len(unknown_users)))
+            with metrics.timer('directory'):
+                for channel_id in unknown_channels:
+                    self.channels[channel_id] = self.lookup('channels', channel_id)
+                for user_id in unknown_users:
+                    self.users[user_id] = self.lookup('users', user_id)
+                self.save()
+
+def directory_cache_path(token):
+    """Where to cache the names for the workspace `token` belongs to."""
+    digest = hashlib.sha256(token.encode()).hexdigest()[:12]
+    return os.path.join(DIRECTORY_CACHE_DIR, '.slack_directory_%s.json' % digest)
+
+_directories = {}
+_directories_lock = threading.Lock()
+
+def get_directory(token):
+    """Return the loaded Directory for `token`, or None if it couldn't be loaded."""
+    with _directories_lock:
+        if token not in _directories:
+            directory = Directory(token, cache_path=directory_cache_path(token))
+            if not directory.load():
+                return None
+            _directories[token] = directory
+        return _directories[token]
@@ -1,22 +1,47 @@
-import csv
 import time
 import calendar
 import datetime
-from urllib.request import Request, urlopen
-from collections import namedtuple
+import heapq
+from collections import namedtuple, Counter, defaultdict, deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-import requests
 import os
 import sys
 
+from slack_utils import get_client, backoff_delay
+from slack_metrics import metrics
+from slack_directory import get_directory
+import slack_inventory
+import slack_journal
+import slack_dedup
+import slack_policy
+from file_table import FileTable
+
 DEBUG = True
 MIN = 60
+DAY = 24 * 60 * MIN
+DEFAULT_DAYS_AGO = 30
+DEFAULT_WORKERS = 4
+DEFAULT_PAGE_WORKERS = 1      # files.list is rate limited, so prefetching is opt-in
+DEFAULT_PAGE_SIZE = 1000      # Slack's own default is 100
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 16 * 1024 * 1024   # files bigger than this are spooled to a temp file on their way into a zip
+DELETE_BATCH_SIZE = 50      # files.delete allows about 50 calls a minute
+DELETE_ROUNDS = 3
+NOT_FOUND_ERRORS = ('file_not_found', 'file_deleted')
+DELETED_OUTCOMES = ('deleted', 'not_found')
+# files.delete errors that trying again won't fix
+PERMANENT_DELETE_ERRORS = ('cant_delete_file', 'not_authed', 'invalid_auth', 'account_inactive',
+                           'missing_scope', 'not_allowed_token_type', 'no_permission')
+JOURNAL_FILE = 'slack_cleanup_journal.jsonl'
+LOG_FILE = 'files_to_act_on.csv'
 DOWNLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
                             "archive_{:%Y-%m-%d}".format(datetime.datetime.now()))
 
 SLACK_FILE_ATTRIBUTES = ['id',       'name',     'permalink', 
                          'created',  'user',     'size', 
-                         'channels', 'filetype', 'action']
+                         'channels', 'filetype', 'action', 'result']
 SlackFile = namedtuple('SlackFile', SLACK_FILE_ATTRIBUTES)
 
 def filename_string(file):
@@ -53,125 +78,319 @@ def get_slack_file(f, channels, users):
                      size=size,
                      filetype=filetype,
                      action='',
+                     result='',
                      channels=file_channels)
 
 def get_slack_files(files, channel_list, user_list):
     return [get_slack_file(f, channel_list, user_list) for f in files]
 
+def inventory_row(slackfile):
+    """Convert a SlackFile to a dict for storing in the inventory."""
+    row = slackfile._asdict()
+    row['created'] = slackfile.created.timestamp()
+    return row
 
-def handle_logging(log_name, files_to_act_on):
+def slack_file_from_row(row):
+    """Convert an inventory row back to a SlackFile."""
+    return SlackFile(**{ attr : row[attr] for attr in SLACK_FILE_ATTRIBUTES })._replace(
+        created=datetime.datetime.fromtimestamp(row['created']))
+
+
+def log_files(log_name, files_to_act_on):
+    """Write each file to the CSV log as it comes through, passing it on to
+    the next stage of the pipeline."""
+    import csv
     with open(log_name, 'w') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=SLACK_FILE_ATTRIBUTES)
         writer.writeheader()
         for slackfile in files_to_act_on:
             writer.writerow(slackfile._asdict())
+            yield slackfile
+
+def read_log(log_name):
+    """Read back the SlackFiles written to a CSV log by `log_files`."""
+    import csv
+    with open(log_name, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            yield SlackFile(**row)._replace(created=datetime.datetime.fromisoformat(row['created']),
+                                            size=int(row['size']))
+
+def handle_logging(log_name, files_to_act_on):
+    if isinstance(files_to_act_on, FileTable):
+        files_to_act_on.write_csv(log_name, SLACK_FILE_ATTRIBUTES)
+        return
+    for _ in log_files(log_name, files_to_act_on):
+        pass
 
 def delete_request(token, slackfile):
-    delete_url = 'https://slack.com/api/files.delete'
-    resp_delete = requests.post(delete_url, data={
-        'token': token,
-        'file': slackfile.id
-    })
+    """Delete a file from Slack. Returns 'deleted', 'not_found' (the file was
+    already gone, e.g. deleted by an earlier try whose response got lost) or
+    the error Slack gave."""
+    # See https://api.slack.com/methods/files.delete
+    try:
+        with metrics.timer('delete'):
+            resp = get_client(token).api_result('files.delete', {'file': slackfile.id},
+                                                expected_errors=NOT_FOUND_ERRORS)
+        if resp['ok']:
+            outcome = 'deleted'
+        elif resp.get('error') in NOT_FOUND_ERRORS:
+            outcome = 'not_found'
+        else:
+            outcome = resp.get('error') or 'unknown_error'
+    except Exception as e:
+        print("Failed: %s (%s): %s" % (slackfile.name, slackfile.id, e), file=sys.stderr)
+        outcome = 'exception'
+    metrics.count('deletes', outcome=outcome)
 
     if DEBUG:
-        # TODO: Look out for HTTP 429 Too Many Requests responses and sleep for Retry-After seconds with a fallback to 1 second
-        if resp_delete.status_code == 429:
-            import pdb; pdb.set_trace()
-
-        if resp_delete.ok and resp_delete.json()['ok']:
+        if outcome in DELETED_OUTCOMES:
             print("Deleted: %s (%s) uploaded by %s on %s has been deleted" % (slackfile.name,
                                                                               slackfile.id,
                                                                               slackfile.user,
                                                                               slackfile.created))
         else:
-            print("Failed: %s (%s) uploaded by %s on %s failed to delete" % (slackfile.name,
-                                                                             slackfile.id,
-                                                                             slackfile.user,
-                                                                             slackfile.created))
+            print("Failed: %s (%s) uploaded by %s on %s failed to delete (%s)" % (slackfile.name,
+                                                                                  slackfile.id,
+                                                                                  slackfile.user,
+                                                                                  slackfile.created,
+                                                                                  outcome))
+    return outcome
 
-def list_request(token, upperbound, page=1):
+def list_request(token, upperbound, page=1, count=DEFAULT_PAGE_SIZE, lowerbound=None):
     # See https://api.slack.com/methods/files.list
-    files_list_url = 'https://slack.com/api/files.list'
-    lowerbound = upperbound - datetime.timedelta(days=31)
     ts_upperbound = str(calendar.timegm(upperbound.utctimetuple()))
     data = {
-        'token': token,
         'ts_to': ts_upperbound,
-        'page': page
+        'page': page,
+        'count': count
     }
-    resp = requests.post(files_list_url, data=data)
-
-    if DEBUG:
-        # TODO: Look out for HTTP 429 Too Many Requests responses and sleep for Retry-After seconds with a fallback to 1 second
-        if resp.status_code == 429:
-            import pdb; pdb.set_trace()
-
-    if resp.ok and resp.json()['ok']:
-        return resp.json()
-    print("%s: %s" % (resp.status_code, resp.text), file=sys.stderr)
-    return None  # TODO: raise error instead of handling None case?
+    if lowerbound:
+        data['ts_from'] = str(calendar.timegm(lowerbound.utctimetuple()))
+    return get_client(token).api_call('files.list', data)
 
 def other_list_request(token,type):
     # See https://api.slack.com/methods/channels.list
     # and https://api.slack.com/methods/users.list
     if not type in ['channels', 'users']:
         return None
-        
-    list_url = "https://slack.com/api/%s.list" % type
-
-    data = {
-        'token': token
-    }
-    resp = requests.post(list_url, data=data)
-
-    if DEBUG:
-        # TODO: Look out for HTTP 429 Too Many Requests responses and sleep for Retry-After seconds with a fallback to 1 second
-        if resp.status_code == 429:
-            import pdb; pdb.set_trace()
 
-    if resp.ok and resp.json()['ok']:
-        return resp.json()
-    print("%s: %s" % (resp.status_code, resp.text), file=sys.stderr)
-    return None  # TODO: raise error instead of handling None case?
+    return get_client(token).api_call('%s.list' % type)
 
 def filter_slack_files(slack_files, min_file_size):
+    upload_total = 0
+    for slackfile in slack_files:
+        upload_total += slackfile.size
+        if slackfile.size > min_file_size:
+            yield slackfile
+        else:
+            metrics.count('files_too_small')
     if DEBUG:
-        upload_total = 0
-        for slackfile in slack_files:
-            upload_total += slackfile.size
-            print("Filesize %s" % sizeof_fmt(slackfile.size))
         print("Filesize %s" % sizeof_fmt(upload_total))
-    return [slackfile for slackfile in slack_files if slackfile.size > min_file_size]
 
-def get_files_to_act_on(token, n_days_ago, min_file_size=None):
-    upperbound = datetime.datetime.now() - datetime.timedelta(days=n_days_ago)
-    resp = list_request(token, upperbound)
+def iter_file_pages(token, upperbound, page_workers=DEFAULT_PAGE_WORKERS,
+                    page_size=DEFAULT_PAGE_SIZE, lowerbound=None):
+    """Yield the `files` list from each page of the files.list results, so
+    callers can start work before the last page arrives.
+
+    Slack pages by offset, newest files first, so deleting a file moves every
+    older file up a place. To make it safe to delete files while still listing
+    them, the pages are handed back from the last (oldest) to the first: a
+    deletion then only affects pages that have already been fetched.
+
+    Once the first page tells us how many pages there are, up to
+    `page_workers` of the remaining pages are fetched at once (still subject to
+    the client's rate limiting). Only files created after `lowerbound` are
+    listed, if it is given. Raises IOError if any page fails, the first
+    included, so callers can tell a failed listing from an empty one.
+    """
+    resp = list_request(token, upperbound, count=page_size, lowerbound=lowerbound)
     if not resp:
-        return []
-        
-    channel_resp = other_list_request(token, 'channels')
-    if not channel_resp:
-        return []
-    
-    user_resp = other_list_request(token, 'users')
-    if not user_resp:
-        return[]
-    
-    # Construct dictionaries mapping user and channel IDs to their names
-    channels = { c['id'] : c['name'] for c in channel_resp['channels'] }
-    users = { user['id'] : user['name'] for user in user_resp['members'] }
+        raise IOError("Couldn't list files")
 
-    slack_files = get_slack_files(resp['files'], channels, users)  # asdf
-    if resp['paging']['pages'] > 1:
-        for page in range(resp['paging']['page']+1, resp['paging']['pages']+1):
-            _resp = list_request(token, upperbound, page=page)
-            slack_files.extend(get_slack_files(_resp['files'], channels, users))
+    pages = range(resp['paging']['pages'], resp['paging']['page'], -1)
 
-    if DEBUG:
-        print("Total files to delete %s" % len(slack_files))
+    with ThreadPoolExecutor(max_workers=max(1, page_workers)) as pool:
+        # Keep a window of requests in flight, and hand pages back in order
+        # (last page first)
+        in_flight = deque()
+        pages = iter(pages)
+        for page in pages:
+            in_flight.append((page, pool.submit(list_request, token, upperbound, page, page_size,
+                                                  lowerbound)))
+            if len(in_flight) >= page_workers:
+                break
+
+        while in_flight:
+            page, future = in_flight.popleft()
+            _resp = future.result()
+            if not _resp:
+                for _, future in in_flight:
+                    future.cancel()
+                raise IOError("Stopped listing files at page %s of %s" % (page,
+                                                                          resp['paging']['pages']))
+            
+            next_page = next(pages, None)
+            if next_page is not None:
+                in_flight.append((next_page, pool.submit(list_request, token, upperbound,
+                                                         next_page, page_size, lowerbound)))
+            yield _resp['files']
+
+    yield resp['files']
+
+def iter_named_pages(directory, pages):
+    """Pass pages of files through, making sure `directory` has a name for
+    every channel and user they mention."""
+    for page in pages:
+        directory.resolve_files(page)
+        yield page
+
+def iter_files_to_act_on(token, n_days_ago, min_file_size=None,
+                         page_workers=DEFAULT_PAGE_WORKERS, page_size=DEFAULT_PAGE_SIZE):
+    """Lazily yield SlackFiles older than `n_days_ago` (and bigger than
+    `min_file_size`, if given) as each page of results comes in."""
+    upperbound = datetime.datetime.now() - datetime.timedelta(days=n_days_ago)
+
+    directory = get_directory(token)
+    if directory is None:
+        return
+
+    pages = iter_file_pages(token, upperbound, page_workers, page_size)
+    slack_files = (get_slack_file(f, directory.channels, directory.users)
+                   for page in iter_named_pages(directory, pages)
+                   for f in page)
     if min_file_size:
         slack_files = filter_slack_files(slack_files, min_file_size)
+
+    try:
+        yield from slack_files
+    except IOError as e:
+        print(e, file=sys.stderr)
+
+def sync_inventory(token, inventory, n_days_ago, page_workers=DEFAULT_PAGE_WORKERS,
+                   page_size=DEFAULT_PAGE_SIZE):
+    """Add files older than `n_days_ago` to the inventory, only asking Slack
+    for files uploaded since the last complete listing. Returns the number of
+    files listed."""
+    upperbound = datetime.datetime.now() - datetime.timedelta(days=n_days_ago)
+    listed_to = inventory.listed_to()
+    lowerbound = datetime.datetime.fromtimestamp(listed_to) if listed_to else None
+
+    if lowerbound and lowerbound >= upperbound:
+        return 0
+
+    directory = get_directory(token)
+    if directory is None:
+        return 0
+
+    listed = 0
+    pages = iter_file_pages(token, upperbound, page_workers, page_size, lowerbound)
+    try:
+        for page in iter_named_pages(directory, pages):
+            inventory.add_files([inventory_row(get_slack_file(f, directory.channels,
+                                                              directory.users))
+                                 for f in page])
+            listed += len(page)
+    except IOError as e:
+        # Leave the high-water mark alone so the next run lists these again
+        print(e, file=sys.stderr)
+        return listed
+
+    inventory.set_listed_to(upperbound.timestamp())
+
+    if DEBUG:
+        print("Listed %s new files into %s" % (listed, inventory.path))
+
+    return listed
+
+def iter_inventory_files(inventory, n_days_ago, min_file_size=None):
+    """Yield SlackFiles from the inventory that are older than `n_days_ago`,
+    bigger than `min_file_size` (if given) and not yet deleted."""
+    upperbound = datetime.datetime.now() - datetime.timedelta(days=n_days_ago)
+    for row in inventory.iter_files(created_before=upperbound.timestamp(),
+                                    min_size=min_file_size):
+        yield slack_file_from_row(row)
+
+def plan_from_inventory(inventory, n_days_ago, min_file_size=None, policy=None,
+                        free_bytes=None, channel_weights=None, filetype_weights=None):
+    """Work out what a run would do from the inventory alone, without asking
+    Slack or writing anything. Returns the number of files and bytes for each
+    action.
+    
+    Without `free_bytes`, the inventory is grouped by file type, channels and
+    user, and only groups where the policy has age or size rules are looked at
+    file by file. Quota planning needs every file, in a FileTable.
+    """
+    policy = as_policy(policy)
+    created_before = (datetime.datetime.now() - datetime.timedelta(days=n_days_ago)).timestamp()
+    
+    if free_bytes is not None:
+        table = FileTable(SlackFile)
+        table.extend_rows(inventory.iter_files(created_before=created_before,
+                                               min_size=min_file_size,
+                                               columns=SLACK_FILE_ATTRIBUTES))
+        table_file_actions(table, policy)
+        plan_quota(table, free_bytes, channel_weights, filetype_weights)
+        return table.totals('action')
     
+    counts, sizes = Counter(), Counter()
+    by_file = set()
+    for filetype, channels, user, files, total in inventory.group_totals(
+            ['filetype', 'channels', 'user'], created_before, min_file_size):
+        candidates = policy.candidates(filetype, channels, user)
+        if len(candidates) == 1:
+            action = candidates[0][-1]
+            counts[action] += files
+            sizes[action] += total
+        else:
+            by_file.add((filetype, channels, user))
+    
+    if by_file:
+        for filetype, channels, user, created, size in inventory.iter_files(
+                created_before=created_before, min_size=min_file_size,
+                columns=['filetype', 'channels', 'user', 'created', 'size']):
+            if (filetype, channels, user) in by_file:
+                action = policy.pick(policy.candidates(filetype, channels, user), created, size)
+                counts[action] += 1
+                sizes[action] += size
+    return { action : (count, sizes[action]) for action, count in counts.items() }
+
+def print_plan(totals):
+    for action in sorted(totals):
+        count, size = totals[action]
+        print("%-16s %8s files %10s" % (action, count, sizeof_fmt(size)))
+    print("Would free %s" % sizeof_fmt(sum(size for action, (_, size) in totals.items()
+                                           if 'delete' in action)))
+
+def result_status(result):
+    """The 'ok', 'failed' or 'skipped' part of a file's `result`, without the
+    reason a failed delete may carry (e.g. 'failed:cant_delete_file')."""
+    return result.partition(':')[0]
+
+def record_files(inventory, files, commit_every=100):
+    """Record each file's action, result and new state in the inventory as
+    it comes through, passing it on to the next stage of the pipeline."""
+    for count, slackfile in enumerate(files, 1):
+        status = result_status(slackfile.result)
+        if status == 'failed':
+            state = slack_inventory.FAILED
+        elif status == 'ok':
+            state = slack_inventory.DELETED if 'delete' in slackfile.action \
+                    else slack_inventory.ARCHIVED
+        else:
+            state = None
+        
+        inventory.update_file(slackfile.id, action=slackfile.action,
+                              result=slackfile.result, state=state)
+        if count % commit_every == 0:
+            inventory.commit()
+        yield slackfile
+    inventory.commit()
+
+def get_files_to_act_on(token, n_days_ago, min_file_size=None,
+                        page_workers=DEFAULT_PAGE_WORKERS, page_size=DEFAULT_PAGE_SIZE):
+    slack_files = list(iter_files_to_act_on(token, n_days_ago, min_file_size,
+                                            page_workers, page_size))
+
     if DEBUG:
         print("Filtered files to delete %s" % len(slack_files))
 
@@ -179,71 +398,549 @@ def get_files_to_act_on(token, n_days_ago, min_file_size=None):
 
 # For debug only
 def print_channel_list(token):
-    resp = other_list_request(token,'channels')
-    if not resp:
+    directory = get_directory(token)
+    if not directory:
         print("No response!?")
+        return
     
-    slack_channels = { c['id'] : c['name'] for c in resp['channels'] }
-    # print("Next cursor: %s" % resp['response_metadata']['next_cursor'])
+    slack_channels = directory.channels
     
     for channel_id in slack_channels.keys():
         print("[%s] %s" % (channel_id, slack_channels[channel_id]))
 
-def assign_file_actions(files, channels_noarchive):
-    actionable_types = ['jpg', 'jpeg', 'png', 'mov', 'mp4']
+def as_policy(policy):
+    """A slack_policy.Policy, made from a --channels_noarchive list if that's
+    what `policy` is."""
+    if isinstance(policy, slack_policy.Policy):
+        return policy
+    return slack_policy.noarchive_policy(policy or "")
+
+def iter_file_actions(files, policy):
+    policy = as_policy(policy)
+    for file in files:
+        yield file._replace(action=policy.action(file))
+
+def assign_file_actions(files, policy):
+    return list(iter_file_actions(files, policy))
+
+def table_file_actions(files, policy):
+    """Like `assign_file_actions`, but returns a FileTable, working out which
+    rules might apply once for each distinct file type, channel list and user
+    rather than per file."""
+    table = files if isinstance(files, FileTable) else FileTable(SlackFile, files)
+    table.assign_actions(as_policy(policy))
+    return table
+
+def tally_actions(table, action_totals=None):
+    """Count the files in `table` for each action and result, like the main
+    loop does. Or, without a table, count the actions in `action_totals` (as
+    returned by `FileTable.totals`)."""
+    tally = Counter()
+    for action, (count, _) in (action_totals or table.totals('action')).items():
+        for name in ('archive', 'delete', 'ignore', 'keep'):
+            if name in action:
+                tally[name] += count
+    if table is None:
+        return tally
+    for result, (count, _) in table.totals('result').items():
+        if result:
+            tally[result_status(result)] += count
+    return tally
+
+def parse_weights(text):
+    """Parse a comma-separated list of name=weight pairs, e.g.
+    "general=0.5,random=2", into a dict."""
+    weights = {}
+    for pair in filter(None, text.split(',')):
+        name, weight = pair.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+def file_priority(size, created, now, channel_factor=1.0, filetype_factor=1.0):
+    """How much we'd like to delete a file of `size` bytes created at
+    `created` (both Unix timestamps, like `now`): its size, counting each year
+    of age as much again (by the day, so half a year adds half), multiplied by
+    the weight of its file type and the highest weight of its channels."""
+    age_years = (now - created) // DAY / 365
+    return size * (1 + age_years) * channel_factor * filetype_factor
+
+def channel_weight(channels, channel_weights=None):
+    return max([(channel_weights or {}).get(c, 1.0) for c in channels.split('+')])
+
+def plan_quota(files, bytes_to_free, channel_weights=None, filetype_weights=None):
+    """Choose which of the files due to be deleted actually need deleting to
+    free `bytes_to_free`, taking them in order of `file_priority` (biggest and
+    oldest first) until enough space is freed. The rest have their action
+    changed to 'keep'. Returns the files, in their original order, as a
+    FileTable (`files` itself, if it is one).
+    
+    Builds one heap over all the files and pops only as many as needed, so
+    this takes O(n + k log n) for k files chosen. The weights are worked out
+    once per distinct channel list and file type, not per file.
+    """
+    table = files if isinstance(files, FileTable) else FileTable(SlackFile, files)
+    now = time.time()
+    channel_factor = [channel_weight(c, channel_weights) for c in table.channel_names.values]
+    filetype_factor = [(filetype_weights or {}).get(t, 1.0) for t in table.filetype_names.values]
     
-    channels_not_to_archive = channels_noarchive.split(',') if channels_noarchive else []
-    examined_files = []
+    deletable = table.select(action='delete')
+    heap = [(-file_priority(table.sizes[index], table.created[index], now,
+                            channel_factor[table.channels[index]],
+                            filetype_factor[table.filetypes[index]]),
+             index)
+            for index in deletable]
+    heapq.heapify(heap)
     
-    for file in files:
-        file_channels = file.channels.split('+')
-        dont_archive = set(file_channels).issubset(channels_not_to_archive)
+    chosen = set()
+    freed = 0
+    while heap and freed < bytes_to_free:
+        _, index = heapq.heappop(heap)
+        chosen.add(index)
+        freed += table.sizes[index]
+    
+    if DEBUG:
+        print("Planned to free %s of %s with %s files" % (sizeof_fmt(freed),
+                                                          sizeof_fmt(bytes_to_free),
+                                                          len(chosen)))
+    
+    for index in deletable:
+        if index not in chosen:
+            table.set_action(index, 'keep')
+    return table
+
+def workspace_usage(token, page_workers=DEFAULT_PAGE_WORKERS, page_size=DEFAULT_PAGE_SIZE):
+    """Total size of all the files in the workspace, in bytes, or None if
+    they couldn't all be listed."""
+    try:
+        return sum(f['size'] for page in iter_file_pages(token, datetime.datetime.now(),
+                                                         page_workers, page_size)
+                   for f in page)
+    except IOError as e:
+        print("Couldn't work out the workspace's usage: %s" % e, file=sys.stderr)
+        return None
+
+def hash_file(filename, digest=None):
+    """Feed the contents of a file into a hash (a new SHA-256 by default)."""
+    digest = digest or slack_dedup.new_hash()
+    with open(filename, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+def stored_copy(file, sha256, dedup):
+    """The (arcname, volume) of the zipped copy of the contents `sha256`, or
+    None. A file is never a duplicate of its own copy."""
+    location = dedup.location(sha256)
+    return location if location and location[0] != filename_string(file) else None
+
+def earlier_copy(file, dedup):
+    """If the contents of `file` were archived by an earlier run, returns the
+    (sha256, (arcname, volume)) of that copy, otherwise None."""
+    sha256 = dedup.hash_for_file(file.id)
+    location = sha256 and stored_copy(file, sha256, dedup)
+    return (sha256, location) if location else None
+
+def download_to_zip(file, token, zip_writer, dedup=None):
+    """Download a file straight into a zipfolder.ZipStreamWriter.
+
+    The download is held in memory (or a temp file, if it is bigger than
+    SPOOL_SIZE) only until its size has been checked and it has been added to
+    the zip, which happens one file at a time. If a slack_dedup.ContentIndex is
+    given as `dedup` and the file's contents have been archived before, only a
+    reference to the earlier copy is added.
+    """
+    arcname = filename_string(file)
+    
+    if dedup:
+        copy = earlier_copy(file, dedup)
+        if copy:
+            sha256, (original_arcname, original_volume) = copy
+            zip_writer.add_reference((arcname, sha256, original_volume or '', original_arcname),
+                                     file)
+            return True
+    
+    if DEBUG:
+        print("Trying to download %s into a zip" % arcname)
+    
+    import tempfile
+    digest = slack_dedup.new_hash()
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+        # Only the download itself is timed here; waiting for and writing to
+        # the zip is timed as 'zip' by the writer.
+        with metrics.timer('download'):
+            download_response = get_client(token).download(file.permalink)
+            with download_response:
+                if download_response.status_code != 200:
+                    raise IOError("HTTP %s downloading %s" % (download_response.status_code,
+                                                              file.permalink))
+                for chunk in download_response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    spool.write(chunk)
+                    digest.update(chunk)
+                    metrics.count('bytes_downloaded', len(chunk))
         
-        if file.filetype in actionable_types:
-            if not file.channels:
-                # file was shared in a private channel/DM
-                # you may want this to be 'delete', but probably not 'archive'
-                file = file._replace(action='ignore')
-            elif dont_archive:
-                file = file._replace(action='delete')
-            else:
-                file = file._replace(action='archive,delete')
-        else:
-            file = file._replace(action='ignore')
+        if spool.tell() != file.size:
+            raise IOError("Downloaded %s bytes of %s, expected %s" % (spool.tell(),
+                                                                      arcname,
+                                                                      file.size))
         
-        examined_files.append(file)
+        sha256 = digest.hexdigest()
+        location = stored_copy(file, sha256, dedup) if dedup else None
+        if location:
+            original_arcname, original_volume = location
+            zip_writer.add_reference((arcname, sha256, original_volume or '', original_arcname),
+                                     file)
+        else:
+            spool.seek(0)
+            # The copy is only recorded once its volume is safely on disk
+            on_sealed = (lambda zip_path: dedup.add_copy(sha256, file.size, arcname,
+                                                         os.path.basename(zip_path))
+                         if dedup else None)
+            zip_writer.add(arcname, spool, file.size, file.created.timetuple()[:6], file,
+                           on_sealed)
         
-    return examined_files
+        if dedup:
+            dedup.add_file(file.id, sha256)
+    
+    return True
+
+def download_slack_file(file, token, zip_writer=None, dedup=None):
+    """Download a file into DOWNLOAD_DIR, a chunk at a time, or into
+    `zip_writer` if one is given (see `download_to_zip`).
 
-def count_action(files, action):
-    return len([f for f in files if action in f.action])
+    The download goes to a `.part` file which is renamed into place once it is
+    complete and synced to disk. If a `.part` file is left over from an earlier
+    attempt, the download resumes where it stopped; if the finished file is
+    already there, nothing is downloaded at all.
 
-def download_slack_file(file, token):
+    If a slack_dedup.ContentIndex is given as `dedup`, the file is hashed as it
+    is downloaded. When its contents have already been archived, the download
+    is discarded and a reference to the earlier copy is added to the
+    DUPLICATES_FILE in DOWNLOAD_DIR instead.
+    """
+    if zip_writer:
+        return download_to_zip(file, token, zip_writer, dedup)
+    
     filename = os.path.join(DOWNLOAD_DIR, filename_string(file))
+    partial_filename = filename + '.part'
+    duplicates_filename = os.path.join(DOWNLOAD_DIR, slack_dedup.DUPLICATES_FILE)
     
+    if os.path.exists(filename) and os.path.getsize(filename) == file.size:
+        if DEBUG:
+            print("Already downloaded %s" % filename)
+        return True
+    
+    if dedup:
+        copy = earlier_copy(file, dedup)
+        if copy:
+            sha256, (original_arcname, original_volume) = copy
+            slack_dedup.append_duplicate(duplicates_filename,
+                                         (filename_string(file), sha256,
+                                          original_volume or '', original_arcname))
+            return True
+    
+    offset = os.path.getsize(partial_filename) if os.path.exists(partial_filename) else 0
+    if offset > file.size:
+        offset = 0
+
     if DEBUG:
         print("Trying to download %s" % filename)
+    
+    digest = slack_dedup.new_hash()
+    if offset < file.size or not os.path.exists(partial_filename):
+        with metrics.timer('download'):
+            headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+            download_response = get_client(token).download(file.permalink, headers)
         
-    with open(filename, 'wb') as handle:
-        download_request = Request(file.permalink)
-        download_request.add_header('Authorization', 'Bearer %s' % token)
-        
-        download_response = urlopen(download_request)
-        handle.write(download_response.read())
+            with download_response:
+                if download_response.status_code == 206:
+                    mode = 'ab'
+                    if dedup:
+                        hash_file(partial_filename, digest)
+                elif download_response.status_code == 200:
+                    mode = 'wb'   # Range was ignored, so start over
+                else:
+                    raise IOError("HTTP %s downloading %s" % (download_response.status_code,
+                                                              file.permalink))
+            
+                with open(partial_filename, mode) as handle:
+                    for chunk in download_response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        handle.write(chunk)
+                        metrics.count('bytes_downloaded', len(chunk))
+                        if dedup:
+                            digest.update(chunk)
+                
+                    # Make sure the archived copy is really on disk before anyone is
+                    # allowed to delete the original from Slack.
+                    handle.flush()
+                    os.fsync(handle.fileno())
+    elif dedup:
+        hash_file(partial_filename, digest)
+    
+    downloaded_size = os.path.getsize(partial_filename)
+    if downloaded_size != file.size:
+        raise IOError("Downloaded %s bytes of %s, expected %s" % (downloaded_size,
+                                                                  filename,
+                                                                  file.size))
+    
+    if dedup:
+        sha256 = digest.hexdigest()
+        location = stored_copy(file, sha256, dedup)
+        if location:
+            original_arcname, original_volume = location
+            slack_dedup.append_duplicate(duplicates_filename,
+                                         (filename_string(file), sha256,
+                                          original_volume or '', original_arcname))
+            os.remove(partial_filename)
+            dedup.add_file(file.id, sha256)
+            return True
+    
+    os.replace(partial_filename, filename)
+    if dedup:
+        dedup.add_copy(sha256, file.size, filename_string(file))
+        dedup.add_file(file.id, sha256)
     
     if DEBUG:
         print("Download success: %s" % filename)
         
     return True
 
-def main(token, do_actions=False, n_days_ago=30, logging_off=False, \
-         min_file_size=None, channels_noarchive=""):
+def already_archived(slackfile, journal, zip_writer=None):
+    """Whether the `journal` says `slackfile` was archived and nothing more is
+    needed. Unless it went into a zip (or has been deleted from Slack since),
+    its download must still be in DOWNLOAD_DIR: a run resumed after midnight
+    downloads into a new folder, and only that one gets zipped."""
+    if not (journal and journal.is_done(slackfile.id, 'archive')):
+        return False
+    return (bool(zip_writer) or journal.is_done(slackfile.id, 'delete')
+            or os.path.exists(os.path.join(DOWNLOAD_DIR, filename_string(slackfile))))
+
+def archive_file(slackfile, token, journal=None, zip_writer=None, dedup=None):
+    """Archive a single file. Skipped if the `journal` says it was already
+    done (see `already_archived`), and recorded there once it is (or, with a
+    `zip_writer`, left for `hold_until_sealed` to record). Returns the file
+    with its `result` set to 'ok' or 'failed'.
+    """
+    try:
+        if not already_archived(slackfile, journal, zip_writer):
+            download_slack_file(slackfile, token, zip_writer, dedup)
+            if journal and not zip_writer:
+                journal.record(slackfile.id, 'archive')
+    except Exception as e:
+        print("Failed: %s (%s): %s" % (slackfile.name, slackfile.id, e), file=sys.stderr)
+        return slackfile._replace(result='failed')
+    
+    return slackfile._replace(result='ok')
+
+def archive_files(files, token, pool, workers=DEFAULT_WORKERS, journal=None, zip_writer=None,
+                  dedup=None):
+    """Archive the files whose action says so on `pool`, keeping up to
+    `workers` * 2 of them queued. Archived files are yielded back (with
+    `result` set) in the order they finish; the others straight away."""
+    pending = set()
+    for slackfile in files:
+        if 'archive' not in slackfile.action:
+            yield slackfile
+            continue
+        
+        pending.add(pool.submit(archive_file, slackfile, token, journal, zip_writer, dedup))
+        
+        # Don't queue up more work than the pool can chew on
+        if len(pending) >= workers * 2:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+def hold_until_sealed(files, zip_writer, journal=None):
+    """Pass files through, except that those archived into `zip_writer` are
+    held back until the zip volume they went into has been finished and synced
+    to disk (and are only then recorded in the `journal`), so none of them can
+    be deleted from Slack before it is safely archived. Once `files` runs out,
+    the last volume is finished so the rest can go too.
+    """
+    held = defaultdict(list)    # files, by how many volumes need sealing first
+    
+    def release(sealed):
+        for volumes in sorted(v for v in held if v <= sealed):
+            for slackfile in held.pop(volumes):
+                if journal and not journal.is_done(slackfile.id, 'archive'):
+                    journal.record(slackfile.id, 'archive')
+                yield slackfile
+    
+    for slackfile in files:
+        if 'archive' in slackfile.action and slackfile.result == 'ok':
+            held[zip_writer.volume_count()].append(slackfile)
+        else:
+            yield slackfile
+        yield from release(zip_writer.sealed_count())
+    
+    zip_writer.seal()
+    yield from release(zip_writer.sealed_count())
+
+def delete_batch(batch, token, pool, journal=None):
+    """Delete a batch of files at once on `pool` (as fast as the files.delete
+    rate limit allows), then retry the ones that failed, for up to
+    DELETE_ROUNDS rounds. Retrying is safe because a file that is already gone
+    counts as deleted. Returns the files, in order, with `result` set to 'ok'
+    or, for files that couldn't be deleted, 'failed:' and what went wrong
+    (Slack's error, or 'exception').
+    """
+    outcomes = {}
+    remaining = batch
+    for attempt in range(DELETE_ROUNDS):
+        if attempt:
+            time.sleep(backoff_delay(attempt))
+        submitted = [(slackfile, pool.submit(delete_request, token, slackfile))
+                     for slackfile in remaining]
+        remaining = []
+        for slackfile, future in submitted:
+            outcome = outcomes[slackfile.id] = future.result()
+            if outcome in DELETED_OUTCOMES:
+                if journal:
+                    journal.record(slackfile.id, 'delete')
+            elif outcome not in PERMANENT_DELETE_ERRORS:
+                remaining.append(slackfile)
+        if not remaining:
+            break
+    
+    return [slackfile._replace(result='ok' if outcomes[slackfile.id] in DELETED_OUTCOMES
+                               else 'failed:%s' % outcomes[slackfile.id])
+            for slackfile in batch]
+
+def delete_files(files, token, pool, journal=None, batch_size=DELETE_BATCH_SIZE):
+    """Delete the files whose action says so, `batch_size` at a time (see
+    `delete_batch`), passing the others on. A file whose archive failed is
+    never deleted. Deletes already recorded in the `journal` are skipped.
+    """
+    batch = []
+    for slackfile in files:
+        if 'archive' in slackfile.action and slackfile.result == 'failed':
+            yield slackfile
+        elif 'delete' not in slackfile.action:
+            yield slackfile._replace(result='ok' if 'archive' in slackfile.action else 'skipped')
+        elif journal and journal.is_done(slackfile.id, 'delete'):
+            yield slackfile._replace(result='ok')
+        else:
+            batch.append(slackfile)
+            if len(batch) >= batch_size:
+                yield from delete_batch(batch, token, pool, journal)
+                batch = []
+    
+    if batch:
+        yield from delete_batch(batch, token, pool, journal)
+
+def act_on_files(files, token, workers=DEFAULT_WORKERS, journal=None, zip_writer=None,
+                 dedup=None, delete_batch_size=DELETE_BATCH_SIZE, pool=None):
+    """Carry out the actions assigned to `files` using a pool of `workers`
+    threads: first archiving, then deleting in batches of `delete_batch_size`.
+    Files are yielded back (with `result` set to 'ok', 'failed' or 'skipped')
+    in the order they finish, not the order they were given. Files archived
+    into a `zip_writer` aren't deleted until their zip volume is finished (see
+    `hold_until_sealed`).
+    
+    Pass an executor as `pool` to run the work on it (e.g. one shared with
+    other workspaces) rather than on a pool of its own.
+    """
+    with nullcontext(pool) if pool else ThreadPoolExecutor(max_workers=workers) as pool:
+        archived = archive_files(files, token, pool, workers, journal, zip_writer, dedup)
+        if zip_writer:
+            archived = hold_until_sealed(archived, zip_writer, journal)
+        yield from delete_files(archived, token, pool, journal, delete_batch_size)
+
+def verify_deletes(token, upperbound, deleted_ids, kept_ids, page_workers=DEFAULT_PAGE_WORKERS,
+                   page_size=DEFAULT_PAGE_SIZE):
+    """List the files created before `upperbound` once more and compare them
+    with what should be left. Returns the ids of deleted files that Slack
+    still lists, and of files that should have been kept but are gone, or
+    None if the listing failed."""
+    listed = set()
+    try:
+        with metrics.timer('verify'):
+            for page in iter_file_pages(token, upperbound, page_workers, page_size):
+                listed.update(f['id'] for f in page)
+    except IOError as e:
+        print("Couldn't verify deletes: %s" % e, file=sys.stderr)
+        return None
+    return deleted_ids & listed, kept_ids - listed
+
+def main(token, do_actions=False, n_days_ago=None, logging_off=False, \
+         min_file_size=None, channels_noarchive="", workers=DEFAULT_WORKERS,
+         page_workers=DEFAULT_PAGE_WORKERS, page_size=DEFAULT_PAGE_SIZE,
+         inventory=None, offline=False, resume=False, zip_writer=None,
+         dedup_index=None, free_bytes=None, target_usage=None,
+         channel_weights=None, filetype_weights=None, policy=None,
+         delete_batch_size=DELETE_BATCH_SIZE, verify=True, pool=None,
+         journal_file=JOURNAL_FILE, log_name=LOG_FILE, plan=False):
     """
-    Deletes Slack files older than `n_days_ago`
+    Deletes Slack files older than `n_days_ago` (default: the policy's
+    `n_days_ago`, or DEFAULT_DAYS_AGO)
 
-    By default files to be deleted are written to `files_to_act_on.csv`, if the delete
-    flag is passed, then the files will also be deleted from slack.
+    What happens to each file is decided by a slack_policy.Policy, or the
+    path of a policy file, given as `policy`. Without one, media files are
+    archived and deleted, except that those only shared in the comma-separated
+    `channels_noarchive` are just deleted.
+
+    By default files to be deleted are written to `log_name`, if the delete
+    flag is passed, then the files will also be deleted from slack, using up to
+    `workers` downloads/deletes at once. The outcome for each file is recorded
+    in the `result` column of the CSV. Deletes are sent `delete_batch_size` at
+    a time, and failures retried; unless `verify` is turned off, the file list
+    is then fetched once more to check that the deleted files are gone and the
+    rest are still there (counted as 'unverified' and 'missing' in the tally).
+    The downloads and deletes are run on `pool`, if given (see `act_on_files`).
+
+    With `plan`, only print how many files (and bytes) would get each action,
+    worked out from the `inventory` without calling Slack or writing a log.
+
+    If an `inventory` database path is given, only files uploaded since the
+    last run are listed from Slack, and the files to act on are taken from the
+    inventory. With `offline`, Slack isn't asked at all and the report is made
+    from the inventory alone.
+
+    Every archive and delete that completes is written to the `journal_file`;
+    with `resume`, the steps recorded there by an interrupted run are skipped.
+
+    Archived files are saved in DOWNLOAD_DIR, unless a zipfolder.ZipStreamWriter
+    is passed as `zip_writer`, in which case they go straight into its zip files.
+    If a `dedup_index` database path is given, files whose contents have been
+    archived before (in this run or an earlier one) are stored as references
+    to the earlier copy instead.
+
+    To free a set amount of space rather than deleting every old file, give
+    either `free_bytes` or a `target_usage` (in bytes) for the whole workspace.
+    Only as many of the files as needed are deleted, biggest and oldest first,
+    as weighted by the `channel_weights` and `filetype_weights` dicts (see
+    `plan_quota`); the others are marked 'keep'.
     """
+    if offline and (do_actions or not inventory):
+        print("--offline needs --inventory and can't be used with --do_actions", file=sys.stderr)
+        return None
+    if offline and target_usage:
+        print("--target_usage needs to ask Slack, so it can't be used with --offline", file=sys.stderr)
+        return None
+    if plan and (do_actions or not inventory or target_usage):
+        print("--plan needs --inventory and can't be used with --do_actions or --target_usage", file=sys.stderr)
+        return None
+    if policy and channels_noarchive:
+        print("--channels_noarchive can't be used with --policy; add a rule to the policy instead", file=sys.stderr)
+        return None
+
+    if isinstance(policy, str):
+        policy = slack_policy.load_policy(policy)
+    policy = as_policy(policy or channels_noarchive)
+    if n_days_ago is None:
+        n_days_ago = policy.n_days_ago if policy.n_days_ago is not None else DEFAULT_DAYS_AGO
+
+    if plan:
+        with slack_inventory.Inventory(inventory) as inventory:
+            totals = plan_from_inventory(inventory, n_days_ago, min_file_size, policy,
+                                         free_bytes, channel_weights, filetype_weights)
+        print_plan(totals)
+        return tally_actions(None, totals)
 
     if DEBUG:
         print("do_actions %s" % do_actions)
@@ -251,40 +948,153 @@ def main(token, do_actions=False, n_days_ago=30, logging_off=False, \
         print("logging_off %s" % logging_off)
         print("min_file_size %s" % min_file_size)
         print("channels_noarchive %s" % channels_noarchive)
+        print("policy %s rules, default %s" % (len(policy.rules), policy.default))
+        print("workers %s" % workers)
+        print("page_workers %s" % page_workers)
+        print("page_size %s" % page_size)
+        print("inventory %s" % inventory)
+        print("offline %s" % offline)
+        print("resume %s" % resume)
+        print("dedup_index %s" % dedup_index)
+        print("free_bytes %s" % free_bytes)
+        print("target_usage %s" % target_usage)
 
-        print_channel_list(token)
+        if not offline:
+            print_channel_list(token)
     
-    files_to_act_on = get_files_to_act_on(token, n_days_ago, min_file_size)
-    files_to_act_on = assign_file_actions(files_to_act_on, channels_noarchive)
+    if target_usage:
+        usage = workspace_usage(token, page_workers, page_size)
+        if usage is None:
+            return None
+        free_bytes = max(0, usage - target_usage)
 
-    if DEBUG:
-        for file in files_to_act_on:
-            print(filename_string(file))
-        
-        print("File to archive: %s" % count_action(files_to_act_on, 'archive'))
-        print("Files to delete: %s" % count_action(files_to_act_on, 'delete'))
-        print("Files to ignore: %s" % count_action(files_to_act_on, 'ignore'))
+    # Each stage below is lazy, so files start being downloaded and deleted
+    # while later pages of the file list are still being fetched.
+    if inventory:
+        inventory = slack_inventory.Inventory(inventory)
+        if not offline:
+            sync_inventory(token, inventory, n_days_ago, page_workers, page_size)
+        files_to_act_on = iter_inventory_files(inventory, n_days_ago, min_file_size)
+    else:
+        files_to_act_on = iter_files_to_act_on(token, n_days_ago, min_file_size,
+                                               page_workers, page_size)
+
+    if not do_actions:
+        # A report needs every file anyway, so collect them into a FileTable
+        # and work on whole columns at once
+        table = table_file_actions(files_to_act_on, policy)
+        if free_bytes is not None:
+            plan_quota(table, free_bytes, channel_weights, filetype_weights)
+        if inventory:
+            for _ in record_files(inventory, table.iter_files()):
+                pass
+        if not logging_off:
+            handle_logging(log_name, table)
+        if DEBUG:
+            for file in table.iter_files():
+                print(filename_string(file))
+        tally = tally_actions(table)
+    else:
+        files_to_act_on = iter_file_actions(files_to_act_on, policy)
+        if free_bytes is not None:
+            # Planning needs to see every file, so this ends the streaming
+            files_to_act_on = plan_quota(files_to_act_on, free_bytes,
+                                         channel_weights, filetype_weights).iter_files()
+
+        if not zip_writer and not os.path.exists(DOWNLOAD_DIR):
+            os.mkdir(DOWNLOAD_DIR)
         
-    if not logging_off:
-        handle_logging('files_to_act_on.csv', files_to_act_on)
+        journal = slack_journal.Journal(journal_file, resume=resume)
+        dedup = slack_dedup.ContentIndex(dedup_index) if dedup_index else None
+        files_to_act_on = act_on_files(files_to_act_on, token, workers, journal, zip_writer,
+                                       dedup, delete_batch_size, pool)
+
+        if inventory:
+            files_to_act_on = record_files(inventory, files_to_act_on)
+
+        if not logging_off:
+            files_to_act_on = log_files(log_name, files_to_act_on)
+
+        tally = Counter()
+        deleted_ids, kept_ids = set(), set()
+        for file in files_to_act_on:
+            if DEBUG:
+                print(filename_string(file))
+            for action in ('archive', 'delete', 'ignore', 'keep'):
+                if action in file.action:
+                    tally[action] += 1
+            if file.result:
+                tally[result_status(file.result)] += 1
+                metrics.count('files', result=result_status(file.result))
+            if 'delete' in file.action and file.result == 'ok':
+                deleted_ids.add(file.id)
+            else:
+                kept_ids.add(file.id)
+
+        if verify:
+            upperbound = datetime.datetime.now() - datetime.timedelta(days=n_days_ago)
+            checked = verify_deletes(token, upperbound, deleted_ids, kept_ids,
+                                     page_workers, page_size)
+            if checked:
+                still_listed, missing = checked
+                tally['unverified'] = len(still_listed)
+                tally['missing'] = len(missing)
+                metrics.count('verified_files', len(deleted_ids) - len(still_listed))
+                metrics.count('unverified_files', len(still_listed))
+                metrics.count('missing_files', len(missing))
+                for file_id in sorted(still_listed):
+                    print("Not deleted after all: %s" % file_id, file=sys.stderr)
+                    if inventory:
+                        inventory.update_file(file_id, result='failed',
+                                              state=slack_inventory.FAILED)
+                for file_id in sorted(missing):
+                    print("Gone, though not deleted by this run: %s" % file_id, file=sys.stderr)
+                if inventory:
+                    inventory.commit()
+
+    if DEBUG:
+        print("File to archive: %s" % tally['archive'])
+        print("Files to delete: %s" % tally['delete'])
+        print("Files to ignore: %s" % tally['ignore'])
+        print("Files to keep: %s" % tally['keep'])
+        if do_actions:
+            print("Files OK: %s" % tally['ok'])
+            print("Files failed: %s" % tally['failed'])
+            if verify:
+                print("Deletes not verified: %s" % tally['unverified'])
+                print("Files missing: %s" % tally['missing'])
 
     if do_actions:
-        if not os.path.exists(DOWNLOAD_DIR):
-            os.mkdir(DOWNLOAD_DIR)
-                
-        for slackfile in files_to_act_on:
-            if 'archive' in slackfile.action:
-                download_slack_file(slackfile, token)
-            if 'delete' in slackfile.action:
-                delete_request(token, slackfile)
+        journal.close()
+        if dedup:
+            dedup.close()
+    if inventory:
+        inventory.close()
+
+    return tally
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser("Bulk archive/delete files older than 30 days")
     parser.add_argument('-t', '--token', type=str, help="Oauth token for Slack RESTfull API")
     parser.add_argument('-d', '--do_actions', action='store_true', help="Confirm file archive/deletion (this cannot be undone)")
-    parser.add_argument('-n', '--n_days_ago', type=int, help="Delete files older than n days ago (default = 30)", default=30)
+    parser.add_argument('-n', '--n_days_ago', type=int, help="Delete files older than n days ago (default = the policy's n_days_ago, or %s)" % DEFAULT_DAYS_AGO)
     parser.add_argument('-l', '--logging_off', action='store_true', help="Turn off CSV logging of deleted files")
     parser.add_argument('-s', '--min_file_size', type=int, help="Min filesize (in bytes) a file must be to get deleted")
     parser.add_argument('-c', '--channels_noarchive', type=str, help="Channels to skip archiving (delete only)")
+    parser.add_argument('-w', '--workers', type=int, help="Number of downloads/deletes to run at once (default = %s)" % DEFAULT_WORKERS, default=DEFAULT_WORKERS)
+    parser.add_argument('-p', '--page_workers', type=int, help="Number of file list pages to fetch at once (default = %s)" % DEFAULT_PAGE_WORKERS, default=DEFAULT_PAGE_WORKERS)
+    parser.add_argument('--page_size', type=int, help="Number of files to ask for per file list page (default = %s)" % DEFAULT_PAGE_SIZE, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument('-i', '--inventory', type=str, help="SQLite file to keep an inventory of Slack files in, so later runs only list new files")
+    parser.add_argument('-o', '--offline', action='store_true', help="Report from the inventory only, without calling Slack (needs --inventory)")
+    parser.add_argument('-r', '--resume', action='store_true', help="Skip downloads/deletes already recorded in the journal by an interrupted run")
+    parser.add_argument('-x', '--dedup_index', type=str, help="SQLite file indexing archived file contents, so duplicates are only archived once")
+    parser.add_argument('-q', '--free_bytes', type=int, help="Only delete as many files as needed to free this many bytes")
+    parser.add_argument('--target_usage', type=int, help="Only delete as many files as needed to bring the workspace down to this many bytes")
+    parser.add_argument('--channel_weights', type=parse_weights, help="With --free_bytes/--target_usage, how much to prefer deleting from each channel, e.g. random=2,general=0.5")
+    parser.add_argument('--filetype_weights', type=parse_weights, help="With --free_bytes/--target_usage, how much to prefer deleting each file type, e.g. mp4=2")
+    parser.add_argument('--delete_batch_size', type=int, help="Number of files to delete at a time, retrying the failures before moving on (default = %s)" % DELETE_BATCH_SIZE, default=DELETE_BATCH_SIZE)
+    parser.add_argument('--no_verify', dest='verify', action='store_false', help="Don't list the files again at the end to check that the deletes took effect")
+    parser.add_argument('--plan', action='store_true', help="Just print how many files and bytes each action would take, from the inventory alone (needs --inventory)")
+    parser.add_argument('--policy', type=str, help="JSON file of rules deciding what to do with each file (see slack_policy.py)")
     main(**vars(parser.parse_args()))
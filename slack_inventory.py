@@ -0,0 +1,149 @@
+import sqlite3
+
+# What has happened to each file so far
+LISTED = 'listed'
+ARCHIVED = 'archived'
+DELETED = 'deleted'
+FAILED = 'failed'
+
+# Files in these states still exist in Slack
+PENDING_STATES = (LISTED, ARCHIVED, FAILED)
+
+INVENTORY_COLUMNS = ['id',       'name',     'permalink',
+                     'created',  'user',     'size',
+                     'channels', 'filetype', 'action',
+                     'result',   'state']
+
+class Inventory:
+    """A local SQLite index of every Slack file we have seen, keyed by file id.
+
+    Besides the file details, each row records the action assigned to the file
+    and its `state` (listed, archived, deleted or failed), so that later runs
+    only have to ask Slack about files uploaded since the last listing.
+    `created` is stored as a Unix timestamp.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id        TEXT PRIMARY KEY,
+                name      TEXT,
+                permalink TEXT,
+                created   REAL,
+                user      TEXT,
+                size      INTEGER,
+                channels  TEXT,
+                filetype  TEXT,
+                action    TEXT DEFAULT '',
+                result    TEXT DEFAULT '',
+                state     TEXT DEFAULT 'listed'
+            );
+            CREATE INDEX IF NOT EXISTS files_created ON files (created);
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+        self.db.commit()
+
+    def listed_to(self):
+        """The `ts_to` of the last complete listing (the high-water mark), or None."""
+        value = self.get_meta('listed_to')
+        return float(value) if value is not None else None
+
+    def set_listed_to(self, timestamp):
+        self.set_meta('listed_to', timestamp)
+
+    def add_files(self, rows):
+        """Insert or refresh listed files. `rows` are dicts with the file
+        details; the state and action of files we already know about are kept."""
+        self.db.executemany("""
+            INSERT INTO files (id, name, permalink, created, user, size, channels, filetype)
+            VALUES (:id, :name, :permalink, :created, :user, :size, :channels, :filetype)
+            ON CONFLICT (id) DO UPDATE SET
+                name = excluded.name, permalink = excluded.permalink,
+                created = excluded.created, user = excluded.user, size = excluded.size,
+                channels = excluded.channels, filetype = excluded.filetype
+        """, rows)
+        self.db.commit()
+
+    def update_file(self, file_id, action=None, result=None, state=None):
+        self.db.execute("""
+            UPDATE files SET action = COALESCE(?, action),
+                             result = COALESCE(?, result),
+                             state  = COALESCE(?, state)
+            WHERE id = ?
+        """, (action, result, state, file_id))
+
+    def commit(self):
+        self.db.commit()
+
+    def iter_files(self, created_before=None, min_size=None, states=PENDING_STATES,
+                   columns=None):
+        """Yield rows (as dicts) for files in one of `states`, optionally only
+        those created before the `created_before` timestamp and bigger than
+        `min_size` bytes, oldest first. If a list of `columns` is given, rows
+        are plain tuples of just those columns, which is quicker."""
+        query = "SELECT %s FROM files WHERE state IN (%s)" % (','.join(columns or ['*']),
+                                                              ','.join('?' * len(states)))
+        params = list(states)
+        if created_before is not None:
+            query += " AND created <= ?"
+            params.append(created_before)
+        if min_size:
+            query += " AND size > ?"
+            params.append(min_size)
+        query += " ORDER BY created"
+
+        if columns:
+            cursor = self.db.cursor()
+            cursor.row_factory = None
+            yield from cursor.execute(query, params)
+            return
+        for row in self.db.execute(query, params):
+            yield dict(row)
+
+    def group_totals(self, columns, created_before=None, min_size=None, states=PENDING_STATES):
+        """Number of files and total bytes for each distinct value of
+        `columns`, among the files `iter_files` would yield, as tuples of
+        (*values, files, bytes)."""
+        query = "SELECT %s, COUNT(*), SUM(size) FROM files WHERE state IN (%s)" % (
+            ','.join(columns), ','.join('?' * len(states)))
+        params = list(states)
+        if created_before is not None:
+            query += " AND created <= ?"
+            params.append(created_before)
+        if min_size:
+            query += " AND size > ?"
+            params.append(min_size)
+        query += " GROUP BY %s" % ','.join(columns)
+
+        cursor = self.db.cursor()
+        cursor.row_factory = None
+        return cursor.execute(query, params).fetchall()
+
+    def totals(self):
+        """Number of files and total bytes for each state."""
+        return { row['state'] : (row['files'], row['bytes'])
+                 for row in self.db.execute("""SELECT state, COUNT(*) AS files, SUM(size) AS bytes
+                                               FROM files GROUP BY state""") }
@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+JOURNAL_SYNC_EVERY = 20     # records between each fsync
+
+class Journal:
+    """An append-only, write-ahead record of completed work.
+
+    Each line is a JSON record of one step (`archive` or `delete`) that has
+    finished for one file. Records are flushed to the OS straight away and
+    fsynced every `sync_every` records, so after a crash at most the last few
+    steps are forgotten (and will simply be done again).
+    """
+
+    def __init__(self, path, resume=False, sync_every=JOURNAL_SYNC_EVERY):
+        self.path = path
+        self.sync_every = sync_every
+        self.completed = replay(path) if resume else {}
+        self.handle = open(path, 'a' if resume else 'w')
+        if self.handle.tell() and not _ends_with_newline(path):
+            # Don't glue our first record onto a torn one
+            self.handle.write('\n')
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+    def is_done(self, file_id, step):
+        return step in self.completed.get(file_id, ())
+
+    def record(self, file_id, step):
+        with self.lock:
+            self.handle.write(json.dumps({'id': file_id, 'step': step, 'time': time.time()}) + '\n')
+            self.handle.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.handle.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+def replay(path):
+    """Read a journal and return a dict mapping each file id to the set of
+    steps already completed for it. A torn last line (from a crash in the
+    middle of a write) is ignored."""
+    completed = defaultdict(set)
+    if not os.path.exists(path):
+        return completed
+
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print("Ignoring unreadable journal line %s in %s" % (line_number, path),
+                      file=sys.stderr)
+                continue
+            completed[record['id']].add(record['step'])
+    return completed
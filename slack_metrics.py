@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+PROMETHEUS_PREFIX = 'slack_cleanup_'
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def _format_key(key, style='json'):
+    name, labels = key
+    if not labels:
+        return name
+    if style == 'prometheus':
+        return '%s{%s}' % (name, ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                                          for k, v in labels))
+    return '%s{%s}' % (name, ','.join('%s=%s' % label for label in labels))
+
+class Metrics:
+    """Collects timings and counts from all over a run.
+
+    `timer` adds up the time spent in a block of code under a name (from any
+    number of threads, so a timer's total can be more than the wall-clock time),
+    and `count` adds to a counter. Both take optional labels, e.g.
+    `count('api_calls', method='files.list')`. At the end of a run the totals
+    can be written out as JSON or as a Prometheus textfile.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = Counter()
+            self.timers = defaultdict(lambda: [0.0, 0])    # key -> [seconds, times]
+
+    def count(self, name, n=1, **labels):
+        with self.lock:
+            self.counters[_key(name, labels)] += n
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                totals = self.timers[_key(name, labels)]
+                totals[0] += elapsed
+                totals[1] += 1
+
+    def summary(self):
+        """Returns all the totals as a dict that can be turned into JSON."""
+        with self.lock:
+            return {
+                'started': self.started,
+                'elapsed_seconds': round(time.time() - self.started, 3),
+                'timers': { _format_key(key) : {'seconds': round(seconds, 3), 'count': times}
+                            for key, (seconds, times) in sorted(self.timers.items()) },
+                'counters': { _format_key(key) : value
+                              for key, value in sorted(self.counters.items()) },
+            }
+
+    def prometheus(self):
+        """Returns all the totals in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            timers = sorted(self.timers.items())
+            counters = sorted(self.counters.items())
+
+        lines.append('# TYPE %sseconds_total counter' % PROMETHEUS_PREFIX)
+        for (name, labels), (seconds, _) in timers:
+            key = ('%sseconds_total' % PROMETHEUS_PREFIX, (('timer', name),) + labels)
+            lines.append('%s %s' % (_format_key(key, 'prometheus'), round(seconds, 3)))
+
+        lines.append('# TYPE %stimed_total counter' % PROMETHEUS_PREFIX)
+        for (name, labels), (_, times) in timers:
+            key = ('%stimed_total' % PROMETHEUS_PREFIX, (('timer', name),) + labels)
+            lines.append('%s %s' % (_format_key(key, 'prometheus'), times))
+
+        typed = set()
+        for (name, labels), value in counters:
+            metric = '%s%s_total' % (PROMETHEUS_PREFIX, name)
+            if metric not in typed:
+                lines.append('# TYPE %s counter' % metric)
+                typed.add(metric)
+            lines.append('%s %s' % (_format_key((metric, labels), 'prometheus'), value))
+
+        lines.append('# TYPE %slast_run_timestamp_seconds gauge' % PROMETHEUS_PREFIX)
+        lines.append('%slast_run_timestamp_seconds %s' % (PROMETHEUS_PREFIX, round(self.started)))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        _write_atomically(path, self.prometheus())
+
+def _write_atomically(path, text):
+    # The Prometheus textfile collector may read the file at any moment
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+# The metrics for this run, shared by all modules
+metrics = Metrics()
@@ -0,0 +1,222 @@
+"""Runs slack_cleanup_cron for several workspaces at once.
+
+Takes a JSON config like:
+
+    {
+        "workers": 8,
+        "workspaces": [
+            {"name": "acme", "token": "xoxp-...", "folder": "/var/www/archives/acme",
+             "url_folder": "https://example.com/archives/acme/",
+             "notify_channel": "general", "policy": "acme_policy.json"},
+            {"name": "beta", "token": "xoxp-...", "folder": "/var/www/archives/beta",
+             "url_folder": "https://example.com/archives/beta/",
+             "notify_channel": "#announcements", "dedup": true}
+        ]
+    }
+
+All the workspaces run at the same time, sharing one pool of `workers`
+download/delete threads. Each workspace can only use its fair share of them
+(the workers divided by the number of workspaces still running), so a huge
+workspace can't hold up the others; once a workspace is done, its share goes
+to the rest. API calls are rate limited per workspace, since each token has
+its own client. Files are zipped as they are downloaded, straight into each
+workspace's folder, and each workspace's journal and CSV log go there too.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import slack_cleanup_cron
+import slack_file_cleanup
+import slack_policy
+from slack_metrics import metrics
+
+DEFAULT_WORKERS = 8
+WORKSPACE_OPTIONS = ['name', 'token', 'folder', 'url_folder', 'notify_channel', 'policy', 'dedup']
+
+class WorkerBudget:
+    """One pool of `workers` threads shared fairly between workspaces.
+
+    Each workspace submits work through its own `executor(name)`. Submitting
+    blocks while that workspace already has its share of work running or
+    queued in the pool. When the workers don't divide evenly, a workspace may
+    go one over its share as long as the pool has a thread free, so the
+    remainder isn't left idle.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.active = set()
+        self.in_flight = Counter()
+        self.cond = threading.Condition()
+
+    def join(self, name):
+        with self.cond:
+            self.active.add(name)
+
+    def leave(self, name):
+        with self.cond:
+            self.active.discard(name)
+            self.cond.notify_all()
+
+    def share(self):
+        return max(1, self.workers // max(1, len(self.active)))
+
+    def can_submit(self, name):
+        share = self.share()
+        if self.in_flight[name] < share:
+            return True
+        return (self.in_flight[name] == share and
+                sum(self.in_flight.values()) < self.workers)
+
+    def submit(self, name, fn, *args, **kwargs):
+        with self.cond:
+            while not self.can_submit(name):
+                self.cond.wait()
+            self.in_flight[name] += 1
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self._finished(name))
+        return future
+
+    def _finished(self, name):
+        with self.cond:
+            self.in_flight[name] -= 1
+            self.cond.notify_all()
+
+    def executor(self, name):
+        return WorkspaceExecutor(self, name)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+class WorkspaceExecutor:
+    """The part of a WorkerBudget belonging to one workspace. It can be used in
+    place of an executor by slack_file_cleanup.act_on_files."""
+
+    def __init__(self, budget, name):
+        self.budget = budget
+        self.name = name
+
+    def submit(self, fn, *args, **kwargs):
+        return self.budget.submit(self.name, fn, *args, **kwargs)
+
+def load_config(path):
+    """Read the config file, checking that each workspace has what it needs
+    and its own folder."""
+    with open(path) as handle:
+        config = json.load(handle)
+
+    workspaces = config.get('workspaces') or []
+    if not workspaces:
+        raise ValueError("No workspaces in %s" % path)
+    for workspace in workspaces:
+        missing = [key for key in ('token', 'folder', 'url_folder', 'notify_channel')
+                   if not workspace.get(key)]
+        if missing:
+            raise ValueError("Workspace %s is missing %s" % (workspace.get('name', '?'),
+                                                             ', '.join(missing)))
+        unknown = set(workspace) - set(WORKSPACE_OPTIONS)
+        if unknown:
+            raise ValueError("Unknown workspace option(s): %s" % ', '.join(sorted(unknown)))
+        workspace.setdefault('name', os.path.basename(os.path.normpath(workspace['folder'])))
+
+    for key in ('name', 'folder'):
+        values = [os.path.abspath(w[key]) if key == 'folder' else w[key] for w in workspaces]
+        if len(set(values)) < len(values):
+            raise ValueError("Each workspace needs its own %s" % key)
+    return config
+
+def run_workspace(workspace, budget, do_actions=False):
+    """Run the cron script for one workspace on its share of `budget`, and
+    return how it went."""
+    name, folder = workspace['name'], workspace['folder']
+    start = time.perf_counter()
+    error = None
+    tally, zip_list = Counter(), []
+    try:
+        with metrics.timer('workspace', workspace=name):
+            tally, zip_list = slack_cleanup_cron.main(
+                workspace['token'], folder, workspace['url_folder'],
+                workspace['notify_channel'], do_actions,
+                stream_zip=True,
+                dedup=workspace.get('dedup', False),
+                policy=workspace.get('policy', slack_policy.DEFAULT_POLICY_FILE),
+                reset_metrics=False,
+                workers=budget.workers,
+                pool=budget.executor(name),
+                journal_file=os.path.join(folder, slack_file_cleanup.JOURNAL_FILE),
+                log_name=os.path.join(folder, slack_file_cleanup.LOG_FILE))
+    except Exception as e:
+        print("[%s] failed: %s" % (name, e), file=sys.stderr)
+        error = str(e)
+    finally:
+        budget.leave(name)
+
+    seconds = time.perf_counter() - start
+    tally = tally or Counter()     # slack_file_cleanup.main returns None on bad options
+    n_files = tally['ok'] + tally['failed']
+    mb = sum(os.path.getsize(f) for f in zip_list) / 1000000
+    metrics.count('workspace_files', n_files, workspace=name)
+    return {
+        'workspace': name,
+        'seconds': round(seconds, 3),
+        'files': n_files,
+        'failed': tally['failed'],
+        'files_per_sec': round(n_files / seconds, 1) if seconds else None,
+        'archived_mb': round(mb, 2),
+        'mb_per_sec': round(mb / seconds, 2) if seconds else None,
+        'error': error,
+    }
+
+def print_results(results):
+    print("%-20s %9s %8s %7s %10s %12s %8s" % ('workspace', 'seconds', 'files', 'failed',
+                                              'files/s', 'archived MB', 'MB/s'))
+    for r in results:
+        print("%-20s %9.2f %8d %7d %10s %12.2f %8s%s" % (r['workspace'], r['seconds'], r['files'],
+                                                      r['failed'], r['files_per_sec'],
+                                                      r['archived_mb'], r['mb_per_sec'],
+                                                      '  (error: %s)' % r['error'] if r['error'] else ''))
+
+def main(config, do_actions=False, workers=None, metrics_dir=None, json_file=None):
+    """Run every workspace in the `config` file at once, sharing `workers`
+    threads (default: the config's "workers", or DEFAULT_WORKERS). Returns a
+    list of per-workspace results."""
+    config = load_config(config)
+    workspaces = config['workspaces']
+    budget = WorkerBudget(workers or config.get('workers') or DEFAULT_WORKERS)
+    metrics.reset()
+
+    # Everyone joins before anyone starts, so the first shares are fair too
+    for workspace in workspaces:
+        budget.join(workspace['name'])
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(workspaces)) as runners:
+            results = list(runners.map(lambda w: run_workspace(w, budget, do_actions),
+                                       workspaces))
+    finally:
+        budget.shutdown()
+
+    print_results(results)
+    if metrics_dir:
+        metrics.write_json(os.path.join(metrics_dir, slack_cleanup_cron.METRICS_JSON_FILE))
+        metrics.write_prometheus(os.path.join(metrics_dir, slack_cleanup_cron.METRICS_PROMETHEUS_FILE))
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser("Run the Slack cleanup cron script for several workspaces at once")
+    parser.add_argument('-c', '--config', type=str, help="JSON file listing the workspaces (see slack_orchestrator.py)", required=True)
+    parser.add_argument('-d', '--do_actions', action='store_true', help="Confirm file archive/deletion (this cannot be undone)")
+    parser.add_argument('-w', '--workers', type=int, help="Number of downloads/deletes to run at once, across all workspaces (default = the config's \"workers\", or %s)" % DEFAULT_WORKERS)
+    parser.add_argument('-m', '--metrics_dir', type=str, help="Folder to write a JSON summary and a Prometheus textfile of the run's timings and counts")
+    parser.add_argument('-j', '--json_file', type=str, help="Also write the per-workspace results to this JSON file")
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,154 @@
+"""Declarative rules for what to do with each Slack file.
+
+A policy is a JSON file like default_policy.json:
+
+    {
+        "n_days_ago": 90,
+        "default": "ignore",
+        "rules": [
+            {"dm": true, "action": "ignore"},
+            {"filetypes": ["jpg", "png"], "only_channels": ["food"], "action": "delete"},
+            {"filetypes": ["jpg", "png"], "min_size": 1000000, "action": "archive,delete"}
+        ]
+    }
+
+Each file gets the action of the first rule whose conditions it meets, or the
+`default` action if none do. The actions are 'archive' (download only),
+'delete', 'archive,delete', 'ignore' and 'keep'. A rule can have any of the
+conditions:
+
+    filetypes      the file is one of these types
+    users          the file was uploaded by one of these users (by name)
+    channels       the file is shared in at least one of these channels
+    only_channels  the file is shared in channels, all of them in this list
+    dm             true: the file isn't shared in any channel (so only in a
+                   private channel or DM); false: it is
+    min_age_days   the file is at least this many days old
+    max_age_days   the file is less than this many days old
+    min_size       the file is at least this many bytes
+    max_size       the file is less than this many bytes
+
+`n_days_ago` is how old files need to be before they are considered at all.
+"""
+import json
+import os
+import time
+from collections import namedtuple
+
+DAY = 24 * 60 * 60
+ACTIONS = ['archive', 'delete', 'archive,delete', 'ignore', 'keep']
+MEDIA_TYPES = ['jpg', 'jpeg', 'png', 'mov', 'mp4']
+DEFAULT_POLICY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'default_policy.json')
+
+RULE_CONDITIONS = ['filetypes', 'users', 'channels', 'only_channels', 'dm',
+                   'min_age_days', 'max_age_days', 'min_size', 'max_size']
+
+# A rule with its name lists turned into sets and its age limits into a
+# range of creation times: created_from < created <= created_to
+Rule = namedtuple('Rule', ['filetypes', 'users', 'channels', 'only_channels', 'dm',
+                           'created_from', 'created_to', 'min_size', 'max_size', 'action'])
+
+def _name_set(rule, key):
+    names = rule.get(key)
+    return frozenset(names) if names is not None else None
+
+def compile_rule(rule, now):
+    unknown = set(rule) - set(RULE_CONDITIONS) - {'action'}
+    if unknown:
+        raise ValueError("Unknown policy rule condition(s): %s" % ', '.join(sorted(unknown)))
+    if rule.get('action') not in ACTIONS:
+        raise ValueError("Policy rule action must be one of %s, not %r" % (ACTIONS, rule.get('action')))
+
+    min_age, max_age = rule.get('min_age_days'), rule.get('max_age_days')
+    return Rule(filetypes=_name_set(rule, 'filetypes'),
+                users=_name_set(rule, 'users'),
+                channels=_name_set(rule, 'channels'),
+                only_channels=_name_set(rule, 'only_channels'),
+                dm=rule.get('dm'),
+                created_from=now - max_age * DAY if max_age is not None else float('-inf'),
+                created_to=now - min_age * DAY if min_age is not None else float('inf'),
+                min_size=rule.get('min_size', 0),
+                max_size=rule.get('max_size', float('inf')),
+                action=rule['action'])
+
+def _matches_names(rule, filetype, channels, user):
+    """Whether a file meets all of `rule`'s conditions other than age and size.
+    `channels` is the set of channels it is shared in."""
+    return ((rule.filetypes is None or filetype in rule.filetypes)
+            and (rule.users is None or user in rule.users)
+            and (rule.channels is None or not rule.channels.isdisjoint(channels))
+            and (rule.only_channels is None or (channels and channels <= rule.only_channels))
+            and (rule.dm is None or rule.dm == (not channels)))
+
+class Policy:
+    """A compiled policy (see the module docstring).
+
+    The name conditions (file type, user and channels) of all the rules are
+    checked once for each distinct combination of them, leaving a short list
+    of candidate rules of which only the age and size ranges need checking
+    for each file.
+    """
+
+    def __init__(self, rules, default='ignore', n_days_ago=None, now=None):
+        if default not in ACTIONS:
+            raise ValueError("Policy default must be one of %s, not %r" % (ACTIONS, default))
+        self.now = time.time() if now is None else now
+        self.rules = [compile_rule(rule, self.now) for rule in rules]
+        self.default = default
+        self.n_days_ago = n_days_ago
+        self._candidates = {}
+
+    @classmethod
+    def from_dict(cls, policy, now=None):
+        return cls(policy.get('rules', []), policy.get('default', 'ignore'),
+                   policy.get('n_days_ago'), now)
+
+    def candidates(self, filetype, channels, user):
+        """The (created_from, created_to, min_size, max_size, action) ranges of
+        the rules that could apply to a file with this type, '+'-joined
+        channel list and user, in order, ending with one that always applies."""
+        key = (filetype, channels, user)
+        candidates = self._candidates.get(key)
+        if candidates is None:
+            channel_set = frozenset(channels.split('+')) if channels else frozenset()
+            candidates = []
+            for rule in self.rules:
+                if _matches_names(rule, filetype, channel_set, user):
+                    candidates.append(rule[5:])
+                    if rule[5:9] == (float('-inf'), float('inf'), 0, float('inf')):
+                        break
+            else:
+                candidates.append((float('-inf'), float('inf'), 0, float('inf'), self.default))
+            candidates = self._candidates[key] = tuple(candidates)
+        return candidates
+
+    @staticmethod
+    def pick(candidates, created, size):
+        """The action of the first of `candidates` whose ranges hold a file
+        created at `created` (a Unix timestamp) of `size` bytes."""
+        for created_from, created_to, min_size, max_size, action in candidates:
+            if created_from < created <= created_to and min_size <= size < max_size:
+                return action
+
+    def action(self, file):
+        """The action for a SlackFile."""
+        return self.pick(self.candidates(file.filetype, file.channels, file.user),
+                         file.created.timestamp(), file.size)
+
+def load_policy(path):
+    """Read and compile the policy file at `path`."""
+    with open(path) as handle:
+        return Policy.from_dict(json.load(handle))
+
+def noarchive_policy(channels_noarchive="", n_days_ago=None):
+    """The policy given by the --channels_noarchive option: archive and delete
+    media files, only deleting those shared just in the comma-separated
+    `channels_noarchive`, and ignore everything else, including DMs."""
+    channels = channels_noarchive.split(',') if channels_noarchive else []
+    # Files only shared in a private channel/DM: you may want this to be
+    # 'delete', but probably not 'archive'
+    rules = [{'dm': True, 'action': 'ignore'},
+             {'filetypes': MEDIA_TYPES, 'only_channels': channels, 'action': 'delete'},
+             {'filetypes': MEDIA_TYPES, 'action': 'archive,delete'}]
+    return Policy(rules, 'ignore', n_days_ago)
@@ -1,43 +1,214 @@
-import requests
+import random
+import threading
+import time
 import sys
 
+from slack_metrics import metrics
+
+SLACK_API_URL = 'https://slack.com/api/'
+
+# Requests per minute allowed for each API method we use.
+# See https://api.slack.com/docs/rate-limits (Tier 2 = 20+/min, Tier 3 = 50+/min)
+METHOD_RATE_LIMITS = {
+    'files.list': 50,
+    'files.delete': 50,
+    'files.upload': 20,
+    'channels.list': 20,
+    'channels.info': 50,
+    'users.list': 20,
+    'users.info': 100,
+    'chat.postMessage': 60,
+}
+DEFAULT_RATE_LIMIT = 20
+
+MAX_RETRIES = 5
+MAX_BACKOFF = 60           # seconds
+REQUEST_TIMEOUT = 60       # seconds without a response before giving up on a try
+RETRYABLE_STATUSES = (500, 502, 503, 504)
+
+class TokenBucket:
+    """A thread-safe token bucket allowing `rate_per_minute` calls per minute,
+    with bursts of up to `capacity` calls."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1, rate_per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Empty the bucket so nobody calls again for `seconds` (e.g. after a 429)."""
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+            self.updated = time.monotonic()
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter, in seconds."""
+    return random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+
+class SlackClient:
+    """Talks to the Slack Web API over a single pooled, keep-alive session.
+
+    Every call goes through a per-method rate limiter. HTTP 429 responses are
+    retried after the Retry-After delay (plus some jitter), and 5xx responses
+    and connection errors are retried with exponential backoff, up to
+    `max_retries` times.
+    """
+
+    def __init__(self, token, max_retries=MAX_RETRIES, pool_size=16):
+        # requests is slow to import, so it's only loaded once a client is needed
+        import requests
+        from requests.adapters import HTTPAdapter
+        
+        self.token = token
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, method):
+        with self.lock:
+            if method not in self.limiters:
+                rate = METHOD_RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT)
+                self.limiters[method] = TokenBucket(rate)
+            return self.limiters[method]
+
+    def request(self, http_method, url, limiter=None, endpoint='other', **kwargs):
+        """Make an HTTP request, retrying on 429, 5xx and connection errors.
+        Returns the last response received; raises the last connection error if
+        no response could be had at all. `endpoint` labels the request in the
+        metrics."""
+        import requests
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                metrics.count('retries', endpoint=endpoint)
+            if limiter:
+                limiter.acquire()
+            metrics.count('http_requests', endpoint=endpoint)
+            try:
+                resp = self.session.request(http_method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.count('connection_errors', endpoint=endpoint)
+                if attempt == self.max_retries:
+                    raise
+                print("[%s] %s, retrying" % (url, e), file=sys.stderr)
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            if resp.status_code == 429:
+                metrics.count('rate_limited', endpoint=endpoint)
+
+            if attempt == self.max_retries:
+                return resp
+
+            if resp.status_code == 429:
+                resp.close()
+                delay = float(resp.headers.get('Retry-After', 1)) + random.uniform(0, 1)
+                if limiter:
+                    limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+                continue
+
+            if resp.status_code in RETRYABLE_STATUSES:
+                resp.close()
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            return resp
+
+    def api_result(self, method, data=None, expected_errors=()):
+        """Call a Slack API method and return the decoded JSON response, even
+        if it failed. Failures that never got a Slack response are returned as
+        {'ok': False, 'error': ...} too, with the error 'request_failed' or
+        'http_<status>'. Errors other than `expected_errors` are logged."""
+        import requests
+        payload = {'token': self.token}
+        payload.update(data or {})
+        metrics.count('api_calls', method=method)
+
+        try:
+            with metrics.timer('api_call', method=method):
+                resp = self.request('POST', SLACK_API_URL + method,
+                                    limiter=self.limiter(method), endpoint=method, data=payload)
+        except requests.RequestException as e:
+            metrics.count('api_errors', method=method)
+            print("[%s] %s" % (method, e), file=sys.stderr)
+            return {'ok': False, 'error': 'request_failed'}
+
+        try:
+            result = resp.json() if resp.ok else None
+        except ValueError:
+            result = None
+        if result is None:
+            result = {'ok': False, 'error': 'http_%s' % resp.status_code}
+        if not result.get('ok'):
+            metrics.count('api_errors', method=method)
+            if result.get('error') not in expected_errors:
+                print("[%s] %s: %s" % (method, resp.status_code, resp.text), file=sys.stderr)
+        return result
+
+    def api_call(self, method, data=None):
+        """Call a Slack API method and return the decoded JSON response,
+        or None if the call failed."""
+        result = self.api_result(method, data)
+        return result if result['ok'] else None  # TODO: raise error instead of handling None case?
+
+    def download(self, url, headers=None):
+        """Start downloading a private file (e.g. a file's `url_private`).
+        The response is streamed; the caller must read and close it."""
+        all_headers = {'Authorization': 'Bearer %s' % self.token}
+        all_headers.update(headers or {})
+        return self.request('GET', url, headers=all_headers, stream=True, endpoint='download')
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(token):
+    """Return the shared SlackClient for `token`, creating it if necessary."""
+    with _clients_lock:
+        if token not in _clients:
+            _clients[token] = SlackClient(token)
+        return _clients[token]
+
 def chat_post_request(token, channel, message):
     """Post a message to a Slack channel"""
-    
+
     # See https://api.slack.com/methods/chat.postMessage
-    chat_api_url = 'https://slack.com/api/chat.postMessage'
-    
     data = {
-        'token': token,
         'channel': channel,
         'as_user': True,
         'parse': 'full',
         'text': message
     }
-    resp = requests.post(chat_api_url, data=data)
-    
-    if resp.ok and resp.json()['ok']:
-        return resp.json()
-    print("[chat.postMessage] %s: %s" % (resp.status_code, resp.text), file=sys.stderr)
-    return None  # TODO: raise error instead of handling None case?
+    return get_client(token).api_call('chat.postMessage', data)
 
 def markdown_post_request(token, channels, title, content, filetype='post'):
     """Create a ‘Post’ in a Slack channel using Markdown formatting."""
-    
+
     # See https://api.slack.com/methods/files.upload
-    file_upload_api_url = 'https://slack.com/api/files.upload'
-    
     data = {
-        'token': token,
         'channels': channels,
         'content': content,
         'title': title,
         'filetype': filetype
     }
-    
-    resp = requests.post(file_upload_api_url, data=data)
-    
-    if resp.ok and resp.json()['ok']:
-        return resp.json()
-    print("[files.upload] %s: %s" % (resp.status_code, resp.text), file=sys.stderr)
-    return None  # TODO: raise error instead of handling None case?
\ No newline at end of file
+    return get_client(token).api_call('files.upload', data)
@@ -0,0 +1,213 @@
+"""End-to-end runs of the cleanup against fake_slack_server, checking above all
+that no file is ever deleted from Slack before its archived copy is safely
+on disk. Run with `python -m pytest`.
+"""
+import csv
+import datetime
+import json
+import os
+import zipfile
+
+import pytest
+
+import archive_index
+import fake_slack_server
+import slack_cleanup_cron
+import slack_dedup
+import slack_directory
+import slack_file_cleanup
+import slack_policy
+import slack_utils
+import zipfolder
+
+N_FILES = 60
+ZERO_BYTE_FILES = ['F00000001', 'F00000002']
+
+@pytest.fixture
+def workspace():
+    workspace = fake_slack_server.FakeWorkspace(n_files=N_FILES, min_size=512, max_size=4096)
+    for file_id in ZERO_BYTE_FILES:
+        workspace.files[file_id]['size'] = 0
+    return workspace
+
+@pytest.fixture
+def server(workspace, tmp_path, monkeypatch):
+    """The fake server, with the scripts pointed at it, quietly, with their
+    rate limits lifted and everything written under `tmp_path`."""
+    with fake_slack_server.FakeSlackServer(workspace, retry_after=0) as server:
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(slack_utils, 'SLACK_API_URL', server.api_url)
+        monkeypatch.setattr(slack_utils, '_clients', {})
+        monkeypatch.setattr(slack_directory, '_directories', {})
+        monkeypatch.setattr(slack_directory, 'DIRECTORY_CACHE_DIR', str(tmp_path))
+        monkeypatch.setattr(slack_file_cleanup, 'DOWNLOAD_DIR', str(tmp_path / 'day1'))
+        monkeypatch.setattr(slack_file_cleanup, 'DEBUG', False)
+        monkeypatch.setattr(slack_directory, 'DEBUG', False)
+        monkeypatch.setattr(zipfolder, 'DEBUG', False)
+        monkeypatch.setattr(slack_utils, 'METHOD_RATE_LIMITS',
+                            { method : 10 ** 9 for method in slack_utils.METHOD_RATE_LIMITS })
+        monkeypatch.setattr(slack_utils, 'DEFAULT_RATE_LIMIT', 10 ** 9)
+        # Small volumes, so that there are several of them
+        monkeypatch.setattr(slack_cleanup_cron, 'ZIP_SIZE_LIMIT_MB', 0.05)
+        yield server
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path / 'archives'
+    folder.mkdir()
+    return str(folder)
+
+def read_duplicates(path):
+    with open(path, newline='') as handle:
+        return list(csv.reader(handle))[1:]
+
+def archived_copies(folder):
+    """The names of the files stored in the finished zip volumes in `folder`,
+    by volume, and the references to stored copies (from the volumes and the
+    download folder), as {name: (volume, name of the copy)}."""
+    stored, references = {}, []
+    for name in os.listdir(folder):
+        if not name.endswith('.zip'):
+            continue
+        try:
+            with zipfile.ZipFile(os.path.join(folder, name)) as volume:
+                stored[name] = set(volume.namelist())
+        except zipfile.BadZipFile:
+            continue    # still being written, so it doesn't count yet
+        references += archive_index.volume_references(os.path.join(folder, name))
+
+    duplicates = os.path.join(slack_file_cleanup.DOWNLOAD_DIR, slack_dedup.DUPLICATES_FILE)
+    if os.path.exists(duplicates):
+        references += read_duplicates(duplicates)
+    return stored, { arcname : (volume, original_arcname)
+                     for arcname, _, volume, original_arcname in references }
+
+def is_archived(slackfile, folder):
+    arcname = slack_file_cleanup.filename_string(slackfile)
+    download = os.path.join(slack_file_cleanup.DOWNLOAD_DIR, arcname)
+    if os.path.exists(download) and os.path.getsize(download) == slackfile.size:
+        return True
+    stored, references = archived_copies(folder)
+    if any(arcname in names for names in stored.values()):
+        return True
+    volume, original_arcname = references.get(arcname, (None, None))
+    return original_arcname in stored.get(volume, ())
+
+@pytest.fixture
+def deletes(folder, monkeypatch):
+    """Checks every delete sent to Slack: files that were to be archived must
+    have their copy on disk by then. Returns the IDs of the files deleted."""
+    deleted = []
+    delete_request = slack_file_cleanup.delete_request
+
+    def checked_delete_request(token, slackfile):
+        if 'archive' in slackfile.action:
+            assert is_archived(slackfile, folder), "%s deleted before archiving" % slackfile.id
+        deleted.append(slackfile.id)
+        return delete_request(token, slackfile)
+
+    monkeypatch.setattr(slack_file_cleanup, 'delete_request', checked_delete_request)
+    return deleted
+
+class Tomorrow(datetime.datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return super().now(tz) + datetime.timedelta(days=1)
+
+def write_policy(tmp_path, action):
+    path = tmp_path / ('%s.json' % action.replace(',', '_'))
+    path.write_text(json.dumps({'n_days_ago': 0, 'default': action, 'rules': []}))
+    return str(path)
+
+def run_cron(folder, policy, stream_zip, **cleanup_options):
+    tally, _ = slack_cleanup_cron.main('xoxp-test', folder, 'https://example.com/', 'general',
+                                       do_actions=True, stream_zip=stream_zip, dedup=True,
+                                       policy=policy, verify=False, **cleanup_options)
+    return tally
+
+def check_index(folder, file_ids):
+    """Every file can be found in the archive index, and extracted in full."""
+    rows = { row['id'] : row for row in archive_index.find(
+        os.path.join(folder, archive_index.INDEX_FILE)) }
+    assert set(file_ids) <= set(rows)
+    for file_id in file_ids:
+        row = rows[file_id]
+        with open(os.devnull, 'wb') as out:
+            assert archive_index.extract(folder, row, out) == int(row['size'])
+
+@pytest.mark.parametrize('stream_zip', [False, True])
+def test_archive_and_delete(server, workspace, folder, deletes, tmp_path, stream_zip):
+    file_ids = sorted(workspace.files)
+    tally = run_cron(folder, write_policy(tmp_path, 'archive,delete'), stream_zip)
+
+    assert tally['ok'] == N_FILES and not tally['failed']
+    assert sorted(deletes) == file_ids
+    assert not workspace.files
+    check_index(folder, file_ids)
+
+@pytest.mark.parametrize('stream_zip', [False, True])
+def test_dedup_rerun(server, workspace, folder, deletes, tmp_path, monkeypatch, stream_zip):
+    """Files whose contents an earlier run archived under another file's name
+    (the fake workspace's re-uploads) are only stored as references to that
+    copy, without being downloaded again. Files are never taken as duplicates
+    of their own earlier copy."""
+    file_ids = sorted(workspace.files)
+    run_cron(folder, write_policy(tmp_path, 'archive'), stream_zip)
+    assert not deletes and len(workspace.files) == N_FILES
+
+    # The next day, with a new download folder and new zip file names
+    monkeypatch.setattr(slack_file_cleanup, 'DOWNLOAD_DIR', str(tmp_path / 'day2'))
+    monkeypatch.setattr(slack_cleanup_cron, 'datetime', Tomorrow)
+    bytes_served = server.bytes_served
+    not_reuploads = sum(f['size'] for file_id, f in workspace.files.items()
+                        if int(file_id[1:]) % 5 != 4)
+    tally = run_cron(folder, write_policy(tmp_path, 'archive,delete'), stream_zip)
+
+    assert tally['ok'] == N_FILES and not tally['failed']
+    assert server.bytes_served - bytes_served == not_reuploads
+    assert not workspace.files
+    check_index(folder, file_ids)
+
+@pytest.mark.parametrize('stream_zip', [False, True])
+def test_resume(server, workspace, folder, deletes, tmp_path, monkeypatch, stream_zip):
+    """A run whose deletes fail part way can be finished with `resume`,
+    without downloading anything again."""
+    file_ids = sorted(workspace.files)
+    checked_delete_request = slack_file_cleanup.delete_request
+
+    def failing_delete_request(token, slackfile):
+        if int(slackfile.id[1:]) % 2:
+            return 'exception'
+        return checked_delete_request(token, slackfile)
+
+    monkeypatch.setattr(slack_file_cleanup, 'DELETE_ROUNDS', 1)
+    with monkeypatch.context() as failing:
+        failing.setattr(slack_file_cleanup, 'delete_request', failing_delete_request)
+        tally = run_cron(folder, write_policy(tmp_path, 'archive,delete'), stream_zip)
+    assert tally['failed'] == N_FILES // 2
+    assert len(workspace.files) == N_FILES // 2
+
+    bytes_served = server.bytes_served
+    tally = run_cron(folder, write_policy(tmp_path, 'archive,delete'), stream_zip, resume=True)
+
+    assert tally['ok'] == N_FILES // 2 and not tally['failed']
+    assert server.bytes_served == bytes_served
+    assert not workspace.files
+    check_index(folder, file_ids)
+
+def test_new_download_folder(server, workspace, folder, deletes, tmp_path, monkeypatch):
+    """Downloads left in an earlier day's folder, which never got zipped, are
+    no substitute for downloading the files again."""
+    dedup_index = str(tmp_path / 'content_index.sqlite')
+    policy = slack_policy.Policy([], 'archive', n_days_ago=0)
+    slack_file_cleanup.main('xoxp-test', True, policy=policy, dedup_index=dedup_index,
+                            verify=False)
+
+    monkeypatch.setattr(slack_file_cleanup, 'DOWNLOAD_DIR', str(tmp_path / 'day2'))
+    policy = slack_policy.Policy([], 'archive,delete', n_days_ago=0)
+    tally = slack_file_cleanup.main('xoxp-test', True, policy=policy, dedup_index=dedup_index,
+                                    verify=False)
+
+    assert tally['ok'] == N_FILES and not tally['failed']
+    assert len(deletes) == N_FILES
+    assert not workspace.files
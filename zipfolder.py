@@ -1,44 +1,95 @@
 import zipfile
 import os
-import statistics
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from slack_dedup import DUPLICATES_FILE, duplicates_csv
+import archive_index
+from slack_metrics import metrics
 
 DEBUG = True
 
-def tell_last(iterable):
-    """A wrapper for iterables, allowing the caller to know whether they are
-    on the last item in the list. (Python has a `first` but not a `last`!)
-    """
-    # Get an iterator and pull the first value.
-    it = iter(iterable)
-    prev = next(it)
-    # Run the iterator to exhaustion (starting from the second value).
-    for val in it:
-        # Report the *previous* value (more to come).
-        yield prev, False
-        prev = val
-    # Report the last value.
-    yield prev, True
+# File types that are already compressed, and are stored in zips as-is
+STORED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'mov', 'mp4', 'zip'}
+
+# Local file header + central directory record, excluding the file name
+# (twice), plus room for zip64 extra fields
+ZIP_ENTRY_OVERHEAD = 30 + 46 + 40
 
-def max_mean_filesizes(folder):
-    """Returns two values, max and median size of files in directory, in bytes."""
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def list_files(folder):
+    """Returns a list of (name, size in bytes) for the files in a folder, sorted
+    by name, in a single pass over the directory. Leftover partial downloads
+    (`.part` files) are skipped."""
     
     if not os.path.isdir(folder):
-        raise FileNotFoundError("%s is not a folder!" % folder_path)
+        raise FileNotFoundError("%s is not a folder!" % folder)
     
-    file_sizes = []
+    with os.scandir(folder) as entries:
+        return sorted((entry.name, entry.stat().st_size) for entry in entries
+                      if entry.is_file() and not entry.name.endswith('.part'))
+
+def compress_type_for(filename):
+    """Media files are already compressed, so deflating them again is wasted
+    CPU: store them as they are."""
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+    return zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+def plan_volumes(files, size_limit_bytes=None):
+    """Split a list of (name, size) into lists of names, one per zip volume.
+    
+    Each volume is filled with files (in order) for as long as their
+    uncompressed size, plus zip headers, stays under `size_limit_bytes`, so
+    the finished zip files end up around the limit: usually under it, but
+    deflating an incompressible file can make it slightly bigger, and a
+    manifest may be added afterwards. A file bigger than the limit gets a
+    volume to itself. With no limit, everything goes in one volume.
+    """
+    volumes = [[]]
+    volume_bytes = 0
+    
+    for name, size in files:
+        entry_bytes = size + ZIP_ENTRY_OVERHEAD + 2 * len(name.encode())
+        if size_limit_bytes is not None and volumes[-1] \
+           and volume_bytes + entry_bytes > size_limit_bytes:
+            volumes.append([])
+            volume_bytes = 0
+        volumes[-1].append(name)
+        volume_bytes += entry_bytes
+    
+    return volumes
+
+def write_volume(zip_path, folder_path, filenames):
+    """Write one zip file containing `filenames` from `folder_path`.
+    Runs in a worker process."""
+    with zipfile.ZipFile(zip_path, mode='w', allowZip64=True) as zip_archive:
+        for filename in filenames:
+            full_file_path = os.path.join(folder_path, filename)
+            zip_archive.write(full_file_path, arcname=filename,
+                              compress_type=compress_type_for(filename))
+            
+            if DEBUG:
+                zipped_info = zip_archive.getinfo(filename)
+                print("Zipped %s, actual/compressed size: %s/%s bytes" % \
+                      (full_file_path, zipped_info.file_size, zipped_info.compress_size))
     
-    for basename in os.listdir(folder):
-        filename = os.path.join(folder, basename)
-        if os.path.isfile(filename):
-            file_sizes.append(os.path.getsize(filename))
+    if DEBUG:
+        print("Created %s" % zip_path)
     
-    return max(file_sizes), statistics.median(file_sizes)
+    return zip_path
 
-def zip_folder(folder_path, zipfile_prefix, rough_size_limit_mb=None):
+def zip_folder(folder_path, zipfile_prefix, rough_size_limit_mb=None, workers=None):
     """Creates zip archive(s) of all files in a folder (non-recursive!)
     Can split the archive into multiple standalone .zip files in order
     to keep them manageable (e.g. for downloading).
     
+    The split between volumes is planned up front from the file sizes, and the
+    volumes are then written in parallel by a pool of processes. Images and
+    videos are stored without compression (see STORED_EXTENSIONS).
+    
     Parameters
     ----------
     folder_path : str
@@ -52,14 +103,14 @@ def zip_folder(folder_path, zipfile_prefix, rough_size_limit_mb=None):
         extension.
         
     rough_size_limit_mb : int, optional
-        How big each zip file should be allowed to grow before closing it and
-        starting a new one. If supplied, it MUST be >= the size of the biggest
-        file plus the median file size, to prevent weirdness. It's "rough"
-        because the first file to bump the size over the limit will be left
-        in the zip file and a new one started for the next file; so the limit
-        will in practice be exceeded by roughly the size of any particular
-        file in the folder (after compression). If omitted, the function will
+        How big each zip file should be allowed to grow before starting a new
+        one. Files are assigned to volumes by their uncompressed size (see
+        `plan_volumes`), so each volume is "roughly" this big; a file bigger
+        than the limit gets a volume of its own. If omitted, the function will
         put everything in one zip file.
+    
+    workers : int, optional
+        How many zip files to write at once. Defaults to the number of CPUs.
         
     Returns
     -------
@@ -67,61 +118,195 @@ def zip_folder(folder_path, zipfile_prefix, rough_size_limit_mb=None):
         A list of all the zip files (with absolute paths) created by the function.
     """
     
-    if not os.path.isdir(folder_path):
-        raise FileNotFoundError("%s is not a folder!" % folder_path)
+    with metrics.timer('zip'):
+        return _zip_folder(folder_path, zipfile_prefix, rough_size_limit_mb, workers)
+
+def _zip_folder(folder_path, zipfile_prefix, rough_size_limit_mb, workers):
+    files = list_files(folder_path)
+    metrics.count('bytes_zipped', sum(size for _, size in files))
     
     path_to_here = os.path.abspath(os.path.dirname(__file__))
     
     if rough_size_limit_mb is not None:
-        biggest_filesize, median_filesize = max_mean_filesizes(folder_path)
-        min_mb_limit = round((biggest_filesize + median_filesize) / 1000000,0)
-        
-        if rough_size_limit_mb < min_mb_limit:
-            raise ValueError("rough_size_limit must be at least %s MB for this folder" \
-                             % min_limit)
-        
-        archive_split_count = 1
-        zipfile_basename = zipfile_prefix + '_001'
-        rough_size_limit_bytes = rough_size_limit_mb * 1000000
+        volumes = plan_volumes(files, rough_size_limit_mb * 1000000)
+        zipfile_basenames = [zipfile_prefix + "_{0:0>3}".format(n)
+                             for n in range(1, len(volumes) + 1)]
     else:
-        zipfile_basename = zipfile_prefix
+        volumes = plan_volumes(files)
+        zipfile_basenames = [zipfile_prefix]
     
-    archive_list = [ os.path.join(path_to_here, zipfile_basename + '.zip') ]
-
-    zip_archive = zipfile.ZipFile(archive_list[0], mode='w') 
-    compressed_total_bytes = 0
+    archive_list = [os.path.join(path_to_here, basename + '.zip')
+                    for basename in zipfile_basenames]
+    
+    if workers == 1 or len(volumes) == 1:
+        for zip_path, filenames in zip(archive_list, volumes):
+            write_volume(zip_path, folder_path, filenames)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # list() so that any worker's exception is raised here
+            list(pool.map(write_volume, archive_list,
+                          [folder_path] * len(volumes), volumes))
     
-    for filename, is_last_file in tell_last(os.listdir(folder_path)):
-        full_file_path = os.path.join(folder_path, filename)
+    return archive_list
 
-        if os.path.isfile(full_file_path):
-            zip_archive.write(full_file_path, arcname=filename,
-                              compress_type=zipfile.ZIP_DEFLATED)
+class ZipStreamWriter:
+    """Adds files to a series of zip volumes as they arrive, so they never
+    have to be saved in a folder and zipped afterwards.
+    
+    Volumes are named like those from `zip_folder` and are created in `folder`
+    (default: next to this script). A new volume is started whenever the next
+    file would take the current one over `rough_size_limit_mb`. Volume numbers
+    already taken by existing files (e.g. from an interrupted run) are skipped
+    rather than overwritten.
+    
+    Each volume is kept open while files are added to it, and is only closed
+    (writing out its central directory) and synced to disk once it is full, or
+    on `seal` or `close`. Until then its files aren't safely archived, so
+    nothing should be deleted from Slack on the strength of them: callers can
+    wait for `sealed_count` to reach the `volume_count` they saw after adding,
+    or pass an `on_sealed` callback to `add`. `add` may be called from several
+    threads; files are written one at a time.
+    
+    References to files stored elsewhere (see `add_reference`) are written to a
+    DUPLICATES_FILE, and a list of the files stored to an
+    archive_index.MANIFEST_FILE, in each volume when it is finished. If an
+    `index_path` is given, the files are also added to that index then, along
+    with the referenced files (pointing at the copies that hold their bytes).
+    """
+    
+    def __init__(self, zipfile_prefix, rough_size_limit_mb=None, folder=None, index_path=None):
+        self.zipfile_prefix = zipfile_prefix
+        self.size_limit_bytes = rough_size_limit_mb * 1000000 if rough_size_limit_mb else None
+        self.folder = folder or os.path.abspath(os.path.dirname(__file__))
+        self.index_path = index_path
+        self.archive_list = []
+        self.zip_archive = None
+        self.zip_path = None
+        self.volume_bytes = 0
+        self.volume_number = 0
+        self.volumes_started = 0
+        self.volumes_sealed = 0
+        self.references = []
+        self.referenced_files = {}
+        self.manifest = []
+        self.sealed_callbacks = []
+        self.lock = threading.Lock()
+    
+    def _finish_volume(self):
+        if self.zip_archive is None:
+            return
+        zip_path = self.zip_path
+        if self.manifest:
+            self.zip_archive.writestr(archive_index.MANIFEST_FILE,
+                                      archive_index.manifest_csv(self.manifest),
+                                      compress_type=zipfile.ZIP_DEFLATED)
+        if self.references:
+            self.zip_archive.writestr(DUPLICATES_FILE, duplicates_csv(self.references),
+                                      compress_type=zipfile.ZIP_DEFLATED)
+        self.zip_archive.close()
+        with open(zip_path, 'rb') as handle:
+            os.fsync(handle.fileno())
+        
+        if self.index_path:
+            rows = self.manifest + archive_index.reference_rows(self.folder, self.references,
+                                                                self.referenced_files)
+            if rows:
+                archive_index.append_index(self.index_path, rows)
+        for callback in self.sealed_callbacks:
+            callback(zip_path)
+        
+        self.zip_archive = None
+        self.zip_path = None
+        self.references = []
+        self.referenced_files = {}
+        self.manifest = []
+        self.sealed_callbacks = []
+        self.volumes_sealed += 1
+        
+        if DEBUG:
+            print("Finished %s, %s bytes" % (zip_path, os.path.getsize(zip_path)))
+    
+    def _start_volume(self):
+        self._finish_volume()
+        if self.size_limit_bytes is None:
+            zip_path = os.path.join(self.folder, self.zipfile_prefix + '.zip')
+        else:
+            while True:
+                self.volume_number += 1
+                zip_path = os.path.join(self.folder, self.zipfile_prefix +
+                                        "_{0:0>3}.zip".format(self.volume_number))
+                if not os.path.exists(zip_path):
+                    break
+        
+        # With no size limit there is only one volume, so carry on adding to it
+        self.zip_archive = zipfile.ZipFile(zip_path, mode='a', allowZip64=True)
+        self.zip_path = zip_path
+        if zip_path not in self.archive_list:
+            self.archive_list.append(zip_path)
+        self.volume_bytes = 0
+        self.volumes_started += 1
+        
+        if DEBUG:
+            print("Created %s" % zip_path)
+    
+    def add(self, arcname, fileobj, size, date_time=None, slackfile=None, on_sealed=None):
+        """Copy `size` bytes from the file object `fileobj` into the current
+        volume as `arcname`, listing it in the manifest with the details of
+        `slackfile`. `on_sealed`, if given, is called with the volume's path
+        once the volume has been finished and synced to disk. Returns the path
+        of the volume it went into."""
+        with self.lock, metrics.timer('zip'):
+            metrics.count('bytes_zipped', size)
+            entry_bytes = size + ZIP_ENTRY_OVERHEAD + 2 * len(arcname.encode())
+            if self.zip_archive is None or (self.size_limit_bytes is not None and self.volume_bytes
+                                            and self.volume_bytes + entry_bytes > self.size_limit_bytes):
+                self._start_volume()
+            zip_path = self.zip_path
             
-            zipped_info = zip_archive.getinfo(filename)
-            file_compressed = zipped_info.compress_size
-            file_size = zipped_info.file_size
+            info = zipfile.ZipInfo(arcname, date_time=date_time or time.localtime()[:6])
+            info.compress_type = compress_type_for(arcname)
             
-            compressed_total_bytes += file_compressed
+            with self.zip_archive.open(info, mode='w',
+                                       force_zip64=size >= zipfile.ZIP64_LIMIT) as dest:
+                shutil.copyfileobj(fileobj, dest, COPY_CHUNK_SIZE)
+            self.volume_bytes += info.compress_size + ZIP_ENTRY_OVERHEAD + 2 * len(arcname.encode())
+            
+            # `info` now knows where the entry starts and its compressed size
+            self.manifest.append(archive_index.manifest_row(info, zip_path, slackfile))
+            if on_sealed:
+                self.sealed_callbacks.append(on_sealed)
             
             if DEBUG:
-                print("Zipped %s, actual/compressed size: %s/%s bytes, total %s" % \
-                      (full_file_path, file_size, file_compressed, compressed_total_bytes))
-
-            if rough_size_limit_mb is not None:
-                if compressed_total_bytes >= rough_size_limit_bytes and not is_last_file:
-                    archive_split_count += 1
-                    zipfile_basename = zipfile_prefix + "_{0:0>3}".format(archive_split_count)
-                
-                    zip_archive.close()
-                    new_zip_name = os.path.join(path_to_here, zipfile_basename + '.zip')
-                    zip_archive = zipfile.ZipFile(new_zip_name, mode='w')
-                    compressed_total_bytes = 0
-                    archive_list.append(new_zip_name)
-
-                    if DEBUG:
-                        print("Created %s" % new_zip_name)
-                
-    zip_archive.close()
+                print("Zipped %s into %s, total %s bytes" % (arcname, zip_path, self.volume_bytes))
+            
+            return zip_path
+    
+    def add_reference(self, reference, slackfile=None):
+        """Note that a file was not stored because it is a duplicate; a tuple of
+        slack_dedup.DUPLICATES_ATTRIBUTES, and the SlackFile it is for."""
+        with self.lock:
+            if self.zip_archive is None:
+                self._start_volume()
+            self.references.append(reference)
+            if slackfile:
+                self.referenced_files[reference[0]] = slackfile
+    
+    def volume_count(self):
+        """How many volumes have been started. Everything added so far is in
+        one of them, so is safely archived once `sealed_count` reaches this."""
+        return self.volumes_started
+    
+    def sealed_count(self):
+        """How many volumes have been finished and synced to disk."""
+        return self.volumes_sealed
+    
+    def seal(self):
+        """Finish the current volume now; anything added later goes in a new one."""
+        with self.lock:
+            self._finish_volume()
     
-    return archive_list
\ No newline at end of file
+    def close(self):
+        """Finishes the last volume and returns the list of zip files written."""
+        with self.lock:
+            self._finish_volume()
+            return list(self.archive_list)